@@ -35,11 +35,17 @@ setup(
         'Topic :: Scientific/Engineering :: GIS',
 
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.11',
     ],
+    python_requires='>=3.11',
     keywords='openstreetmap vectortile postgis',
     packages=find_packages(exclude=['tests']),
     install_requires=install_requires,
-    extras_require={'test': ['pytest'], 'docs': 'mkdocs'},
+    extras_require={'test': ['pytest'], 'docs': 'mkdocs',
+                    'asgi': ['asyncpg'], 'brotli': ['brotli'],
+                    'orjson': ['orjson'], 'redis': ['redis']},
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['utilery=utilery.cli:main'],
+    },
 )
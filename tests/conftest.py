@@ -29,6 +29,7 @@ def pytest_configure(config):
     uconfig.PLUGINS = [TestPlugin]
     from utilery import core
     from utilery.models import Recipe
+    core.init()
     core.RECIPES['default'] = Recipe({
         'name': 'default',
         'layers': [{
@@ -121,3 +122,11 @@ def plugins(monkeypatch):
     monkeypatch.setattr(Plugins, '_hooks', {})
 
     return lambda p: Plugins.register_plugin(p)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    from utilery.cache import Cache, MemoryCache
+    backend = MemoryCache()
+    monkeypatch.setattr(Cache, 'backend', backend)
+    return backend
@@ -0,0 +1,108 @@
+import asyncio
+
+import asyncpg
+import mapbox_vector_tile
+import pytest
+
+from utilery.asgi import AsyncDB, app
+
+
+def request(path, method='GET', headers=None):
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': headers or [],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, body = messages
+    return start['status'], dict(start['headers']), body['body']
+
+
+@pytest.fixture
+def asyncdb(monkeypatch):
+    queries = []
+
+    def _(rows):
+        async def fetchall(statement, args, dbname=None):
+            queries.append((statement, args))
+            await asyncio.sleep(0)
+            return rows
+        monkeypatch.setattr(AsyncDB, 'fetchall', fetchall)
+        return queries
+
+    return _
+
+
+def test_serve_pbf(asyncdb):
+    queries = asyncdb([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    status, headers, body = request('/all/0/0/0.pbf')
+    assert status == 200
+    assert headers[b'content-type'] == b'application/x-protobuf'
+    tile = mapbox_vector_tile.decode(body)
+    assert tile['mylayer']['features'][0]['properties'] == {'name': 'foo'}
+    assert len(queries) == 1
+    statement, args = queries[0]
+    assert '$1::float8' in statement.prepared
+    assert args['zoom'] == 0
+
+
+def test_plugin_hooks_are_called(asyncdb):
+    asyncdb([])
+    status, headers, body = request('/all/0/0/0.pbf')
+    assert headers[b'access-control-allow-origin'] == b'*'
+
+
+def test_unknown_layer_return_400(asyncdb):
+    status, headers, body = request('/unknown/0/0/0.pbf')
+    assert status == 400
+
+
+def test_database_errors_return_500(monkeypatch):
+
+    async def fetchall(*args, **kwargs):
+        raise asyncpg.PostgresSyntaxError('syntax error')
+
+    monkeypatch.setattr(AsyncDB, 'fetchall', fetchall)
+    status, headers, body = request('/all/0/0/0.pbf')
+    assert status == 500
+
+
+def test_non_tile_endpoints(config):
+    status, headers, body = request('/tilejson/mvt.json')
+    assert status == 200
+    assert b'vector_layers' in body
+    status, headers, body = request('/all/0/0/0.pbf', method='OPTIONS')
+    assert status == 200
+
+
+def test_parse_dsn():
+    assert AsyncDB.parse_dsn('dbname=osm user=osm host=localhost') == {
+        'database': 'osm', 'user': 'osm', 'host': 'localhost'}
+
+
+def test_parse_dsn_uri():
+    assert AsyncDB.parse_dsn('postgresql://osm:secret@db:5433/osm') == {
+        'database': 'osm', 'user': 'osm', 'password': 'secret', 'host': 'db',
+        'port': 5433}
+
+
+def test_parse_dsn_quoted_values():
+    assert AsyncDB.parse_dsn("dbname=osm password='a b'") == {
+        'database': 'osm', 'password': 'a b'}
+
+
+def test_parse_dsn_maps_or_drops_libpq_only_keys():
+    params = AsyncDB.parse_dsn('dbname=osm sslmode=require connect_timeout=3 '
+                               'application_name=utilery keepalives=1')
+    assert params == {'database': 'osm', 'ssl': 'require', 'timeout': 3.0,
+                      'server_settings': {'application_name': 'utilery'}}
@@ -0,0 +1,96 @@
+import json
+import logging
+import tracemalloc
+
+import mapbox_vector_tile
+import mercantile
+
+from utilery import bench, cli
+from utilery.bench import (StandInDB, bench_app, bench_encoding, percentile,
+                           synthetic_rows)
+from utilery.core import DB, Rows
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([1], 95) == 1
+
+
+def test_synthetic_rows_follow_the_format():
+    pbf = synthetic_rows('SELECT ST_AsBinary(way)', 2)
+    assert isinstance(pbf[0]['_way'], bytes)
+    geojson = synthetic_rows('SELECT ST_AsGeoJSON(way)', 2)
+    assert json.loads(geojson[1]['_way'])['type'] == 'LineString'
+
+
+def test_stand_in_db_is_installed_and_removed():
+    fetchall = DB.fetchall
+    db = StandInDB({StandInDB.key('SELECT 1', None): [{'a': 1}]})
+    with db.install():
+        assert DB.fetchall('SELECT 1') == [{'a': 1}]
+        assert list(DB.iterate('SELECT 2')) == []
+    assert DB.fetchall == fetchall
+
+
+def test_fixtures_are_recorded_and_replayed(monkeypatch, tmpdir):
+    rows = Rows([(memoryview(b'\x01\x02'), 'foo')], ['_way', 'name'])
+    monkeypatch.setattr('utilery.core.DB.fetchall',
+                        lambda query, args=None, dbname=None: rows)
+    recorder = StandInDB()
+    with recorder.install(record=True):
+        DB.fetchall('SELECT way', {'zoom': 1})
+    path = str(tmpdir.join('fixtures.json'))
+    recorder.save(path)
+    replay = StandInDB.load(path)
+    assert replay.fetchall('SELECT way', {'zoom': 1}) == [
+        {'_way': b'\x01\x02', 'name': 'foo'}]
+
+
+def test_bench_app_reports_per_format():
+    tiles = [mercantile.Tile(0, 0, 1), mercantile.Tile(1, 1, 1)]
+    with StandInDB(features=10).install():
+        results = bench_app(tiles)
+    assert sorted(results) == ['geojson', 'json', 'pbf']
+    stats = results['pbf']
+    assert stats['tiles'] == 2
+    assert stats['p50'] <= stats['p95'] <= stats['p99']
+    assert stats['tiles_per_second'] > 0
+    assert stats['peak_memory'] > 0
+
+
+def test_bench_app_times_requests_without_tracing(monkeypatch):
+    tracing = []
+    request_tiles = bench.request_tiles
+
+    def record(*args):
+        tracing.append(tracemalloc.is_tracing())
+        return request_tiles(*args)
+    monkeypatch.setattr(bench, 'request_tiles', record)
+    with StandInDB(features=10).install():
+        bench_app([mercantile.Tile(0, 0, 1)], formats=['pbf'])
+    assert tracing == [False, True]
+
+
+def test_bench_encoding():
+    results = bench_encoding([10, 100])
+    assert sorted(results) == [10, 100]
+    assert results[100]['features_per_second'] > 0
+
+
+def test_bench_command(caplog):
+    caplog.set_level(logging.INFO)
+    cli.main(['bench', '--maxzoom', '1', '--features', '5', '--sizes', '10',
+              '--formats', 'pbf'])
+    assert 'pbf      5 tiles' in caplog.text
+    assert 'encoding 10 features' in caplog.text
+
+
+def test_synthetic_tiles_are_valid():
+    with StandInDB(features=4).install():
+        from utilery.views import ServePBF
+        view = ServePBF(None)
+        view.setup('all', 1, 0, 0)
+        tile = mapbox_vector_tile.decode(view.render())
+    assert len(tile['mylayer']['features']) == 4
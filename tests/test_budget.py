@@ -0,0 +1,81 @@
+import mapbox_vector_tile
+import shapely.geometry
+
+from utilery import metrics
+from utilery.budget import Budget, priority, ranked
+
+
+def feature(x, **properties):
+    line = shapely.geometry.LineString([(x + i, (i * 7) % 13)
+                                        for i in range(0, 400, 3)])
+    return {'geometry': line.wkb, 'properties': properties}
+
+
+def test_priority():
+    small = {'geometry': 'LINESTRING(0 0, 1 0)', 'properties': {'rank': 3}}
+    big = {'geometry': 'LINESTRING(0 0, 9 0)', 'properties': {}}
+    assert priority(small, 'length') < priority(big, 'length')
+    assert priority(small, 'rank') == 3
+    assert priority(small, '-rank') == 3
+    assert priority(big, 'rank') is None
+
+
+def test_ranked_puts_missing_values_first():
+    features = [{'properties': {'name': name}}
+                for name in ['b', None, 'c', 'a']]
+    assert ranked(features, 'name') == [1, 3, 0, 2]
+    assert ranked(features, '-name') == [1, 2, 0, 3]
+
+
+def test_max_tile_features_drops_by_priority(layer):
+    layer['drop_priority'] = 'rank'
+    data = {'name': 'mylayer',
+            'features': [feature(i, rank=i % 5) for i in range(10)]}
+    Budget(layer.recipe, 0, max_features=4).fit([(layer, data)])
+    assert [f['properties']['rank'] for f in data['features']] == [3, 4, 3, 4]
+
+
+def test_max_tile_features_drops_by_reversed_priority(layer):
+    layer['drop_priority'] = '-name'
+    names = ['b', None, 'e', 'a', 'd', 'c']
+    data = {'name': 'mylayer',
+            'features': [feature(i, name=name) for i, name in
+                         enumerate(names)]}
+    Budget(layer.recipe, 0, max_features=3).fit([(layer, data)])
+    assert [f['properties']['name'] for f in data['features']] == [
+        'b', 'a', 'c']
+
+
+def test_strip_properties_first(layer):
+    layer['strip_properties'] = ['description']
+    data = {'name': 'mylayer', 'features': [
+        {'geometry': 'POINT(1 1)',
+         'properties': {'name': 'foo', 'description': 'x' * 1000}}]}
+    encoded = Budget(layer.recipe, 0, max_size=200).fit([(layer, data)])
+    assert sum(len(e) for e in encoded) <= 200
+    assert data['features'][0]['properties'] == {'name': 'foo'}
+
+
+def test_coarsen_then_drop_until_it_fits(layer):
+    before = metrics.BUDGET_DROPPED.get(recipe='default', layer='mylayer',
+                                        action='features')
+    data = {'name': 'mylayer', 'features': [feature(i) for i in range(50)]}
+    size = len(mapbox_vector_tile.encode([data]))
+    encoded = Budget(layer.recipe, 0, max_size=size // 50).fit(
+        [(layer, data)])
+    assert sum(len(e) for e in encoded) <= size // 50
+    assert 0 < len(data['features']) < 50
+    assert metrics.BUDGET_DROPPED.get(recipe='default', layer='mylayer',
+                                      action='coarsened')
+    assert metrics.BUDGET_DROPPED.get(
+        recipe='default', layer='mylayer',
+        action='features') == before + 50 - len(data['features'])
+
+
+def test_tiles_are_fitted(client, fetchall, layer):
+    layer.recipe['max_tile_features'] = 2
+    layer['drop_priority'] = '-rank'
+    fetchall([{'_way': feature(0)['geometry'], 'rank': i} for i in range(5)])
+    tile = mapbox_vector_tile.decode(client.get('/all/0/0/0.pbf').data)
+    ranks = [f['properties']['rank'] for f in tile['mylayer']['features']]
+    assert ranks == [0, 1]
@@ -0,0 +1,222 @@
+import threading
+import time
+
+import pytest
+
+from utilery.cache import (FileCache, MemoryCache, RedisCache, SingleFlight,
+                           TileKey)
+
+
+def key(z=0, x=0, y=0, names='all', format='pbf', recipe='default'):
+    return TileKey(recipe, names, z, x, y, format)
+
+
+def test_ttl_can_be_set_per_zoom():
+    cache = MemoryCache(ttl={0: 3600, 10: 60, 16: 0})
+    assert cache.timeout(0) == 3600
+    assert cache.timeout(9) == 3600
+    assert cache.timeout(10) == 60
+    assert cache.timeout(18) == 0
+
+
+def test_memory_cache_get_set():
+    cache = MemoryCache()
+    assert cache.get(key()) is None
+    cache.set(key(), b'tile')
+    assert cache.get(key()) == b'tile'
+    assert cache.get(key(format='json')) is None
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(maxsize=2)
+    cache.set(key(x=1), b'1')
+    cache.set(key(x=2), b'2')
+    cache.get(key(x=1))
+    cache.set(key(x=3), b'3')
+    assert cache.get(key(x=1)) == b'1'
+    assert cache.get(key(x=2)) is None
+    assert cache.get(key(x=3)) == b'3'
+
+
+def test_memory_cache_expires_entries(monkeypatch):
+    cache = MemoryCache(ttl=10)
+    cache.set(key(), b'tile')
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    assert cache.get(key()) is None
+
+
+def test_memory_cache_keeps_stale_entries(monkeypatch):
+    cache = MemoryCache(ttl=10, stale=5)
+    cache.set(key(), b'tile')
+    assert cache.get_stale(key()) == (b'tile', False)
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    assert cache.get(key()) is None
+    assert cache.get_stale(key()) == (b'tile', True)
+    monkeypatch.setattr('time.time', lambda: now + 16)
+    assert cache.get_stale(key()) == (None, False)
+
+
+def test_memory_cache_does_not_store_when_ttl_is_zero():
+    cache = MemoryCache(ttl={0: 0, 5: None})
+    cache.set(key(z=4), b'tile')
+    cache.set(key(z=5), b'tile')
+    assert cache.get(key(z=4)) is None
+    assert cache.get(key(z=5)) == b'tile'
+
+
+def test_memory_cache_purge_all_versions_of_a_tile():
+    cache = MemoryCache()
+    cache.set(key(), b'tile')
+    cache.set(key(names='mylayer', format='json'), b'tile')
+    cache.set(key(x=1), b'tile')
+    assert cache.exists(key())
+    cache.purge('default', 0, 0, 0)
+    assert cache.get(key()) is None
+    assert not cache.exists(key())
+    assert cache.get(key(names='mylayer', format='json')) is None
+    assert cache.get(key(x=1)) == b'tile'
+
+
+def test_file_cache_uses_zxy_layout(tmpdir):
+    cache = FileCache(str(tmpdir))
+    cache.set(key(z=3, x=2, y=1), b'tile')
+    assert tmpdir.join('default', '3', '2', '1', 'all.pbf').read_binary() \
+        == b'tile'
+    assert cache.get(key(z=3, x=2, y=1)) == b'tile'
+    assert cache.get(key(z=3, x=2, y=2)) is None
+
+
+def test_file_cache_expires_entries(tmpdir, monkeypatch):
+    cache = FileCache(str(tmpdir), ttl=10)
+    cache.set(key(), b'tile')
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    assert cache.get(key()) is None
+
+
+def test_file_cache_exists_does_not_read_the_tile(tmpdir, monkeypatch):
+    cache = FileCache(str(tmpdir), ttl=10)
+    assert not cache.exists(key())
+    cache.set(key(), b'tile')
+
+    def fail(*args, **kwargs):
+        assert False, 'tile should not be read'
+    monkeypatch.setattr('pathlib.Path.open', fail)
+    assert cache.exists(key())
+    assert not cache.exists(key(format='json'))
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    assert not cache.exists(key())
+
+
+def test_file_cache_keeps_stale_entries(tmpdir, monkeypatch):
+    cache = FileCache(str(tmpdir), ttl=10, stale=5)
+    cache.set(key(), b'tile')
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    assert cache.get_stale(key()) == (b'tile', True)
+    monkeypatch.setattr('time.time', lambda: now + 16)
+    assert cache.get_stale(key()) == (None, False)
+
+
+def test_file_cache_purge_all_versions_of_a_tile(tmpdir):
+    cache = FileCache(str(tmpdir))
+    cache.set(key(), b'tile')
+    cache.set(key(names='mylayer', format='json'), b'tile')
+    cache.set(key(x=1), b'tile')
+    assert cache.exists(key())
+    cache.purge('default', 0, 0, 0)
+    assert cache.get(key()) is None
+    assert not cache.exists(key())
+    assert cache.get(key(names='mylayer', format='json')) is None
+    assert cache.get(key(x=1)) == b'tile'
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+    def hget(self, name, field):
+        return self.data.get(name, {}).get(field)
+
+    def hexists(self, name, field):
+        return field in self.data.get(name, {})
+
+    def hset(self, name, field, value):
+        self.data.setdefault(name, {})[field] = value
+
+    def expire(self, name, timeout):
+        self.expires[name] = timeout
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+
+def test_redis_cache_stores_tile_versions_in_one_hash():
+    client = FakeRedis()
+    cache = RedisCache(client=client, ttl={0: 3600})
+    cache.set(key(), b'tile')
+    cache.set(key(names='mylayer', format='json'), b'json')
+    assert client.data['utilery:default:0:0:0'] == {
+        'all.pbf': b'tile',
+        'mylayer.json': b'json'
+    }
+    assert client.expires['utilery:default:0:0:0'] == 3600
+    assert cache.get(key()) == b'tile'
+    assert cache.exists(key())
+    cache.purge('default', 0, 0, 0)
+    assert cache.get(key()) is None
+    assert not cache.exists(key())
+
+
+def test_single_flight_shares_result():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return b'tile'
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flights.do(key(), compute)))
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(
+        target=lambda: results.append(flights.do(key(), compute)))
+        for i in range(3)]
+    for thread in followers:
+        thread.start()
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(1)
+    assert results == [b'tile'] * 4
+    assert len(calls) == 1
+    # Nothing is kept once landed.
+    assert flights.do(key(), lambda: b'new') == b'new'
+
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+
+    def compute():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flights.do(key(), compute)
+    assert flights.do(key(), lambda: b'tile') == b'tile'
@@ -0,0 +1,294 @@
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+import yaml
+
+from utilery import core
+from utilery.core import DB, Pool, PoolTimeout, Statement
+
+
+class FakeCursor(object):
+
+    description = [('name', 25)]
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, args=None):
+        if self.conn.broken:
+            self.conn.closed = True
+            raise psycopg2.OperationalError('server closed the connection')
+        self.conn.queries.append(query)
+        self.conn.args.append(args)
+
+    def fetchall(self):
+        return [('row', )]
+
+    def fetchmany(self, size):
+        rows = self.conn.rows[:size]
+        self.conn.rows = self.conn.rows[size:]
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = False
+        self.broken = False
+        self.queries = []
+        self.args = []
+        self.prepared = set()
+        self.cursors = []
+        self.rows = []
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self, *args, **kwargs):
+        self.cursors.append(FakeCursor(self))
+        return self.cursors[-1]
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    connections = []
+
+    def _(dsn, **kwargs):
+        conn = FakeConnection(dsn)
+        connections.append(conn)
+        return conn
+
+    monkeypatch.setattr('psycopg2.connect', _)
+    return connections
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    monkeypatch.setattr(DB, '_', {})
+    return DB._
+
+
+def test_pool_opens_minconn_connections(connect):
+    Pool('dbname=test', minconn=2)
+    assert len(connect) == 2
+
+
+def test_pool_reuses_connections(connect):
+    pool = Pool('dbname=test', minconn=0)
+    with pool.connection() as conn:
+        pass
+    with pool.connection() as other:
+        assert other is conn
+    assert len(connect) == 1
+
+
+def test_pool_opens_new_connections_up_to_maxconn(connect):
+    pool = Pool('dbname=test', minconn=0, maxconn=2, timeout=0.01)
+    first = pool.getconn()
+    second = pool.getconn()
+    assert first is not second
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+
+def test_pool_checkout_waits_for_a_released_connection(connect):
+    pool = Pool('dbname=test', minconn=0, maxconn=1, timeout=1)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, [conn]).start()
+    assert pool.getconn() is conn
+
+
+def test_pool_replaces_closed_connections(connect):
+    pool = Pool('dbname=test', minconn=1)
+    connect[0].closed = True
+    with pool.connection() as conn:
+        assert conn is connect[1]
+
+
+def test_pool_health_checks_idle_connections(connect):
+    pool = Pool('dbname=test', minconn=1, check_interval=0)
+    with pool.connection():
+        pass
+    assert connect[0].queries == ['SELECT 1']
+
+
+def test_pool_rollbacks_connections_left_in_transaction(connect):
+    pool = Pool('dbname=test', minconn=0)
+    with pool.connection() as conn:
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    assert conn.status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    with pool.connection() as other:
+        assert other is conn
+
+
+def test_pool_round_trips_are_out_of_the_lock(connect):
+    pool = Pool('dbname=test', minconn=0, check_interval=0)
+    conn = pool.getconn()
+    free = []
+
+    def check():
+        # Other threads can use the pool meanwhile.
+        if pool._lock.acquire(timeout=0):
+            pool._lock.release()
+            free.append(True)
+        else:
+            free.append(False)
+
+    def round_trip():
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join()
+
+    def rollback():
+        round_trip()
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor():
+        round_trip()
+        return FakeCursor(conn)
+    conn.rollback = rollback
+    conn.cursor = cursor
+    conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert free == [True]
+    # Health check: SELECT 1, then rollback.
+    assert pool.getconn() is conn
+    assert free == [True, True, True]
+
+
+def test_db_pool_accepts_dsn_or_dict(connect, pools, config):
+    config.DATABASES = {
+        'default': 'dbname=test',
+        'other': {'dsn': 'dbname=other', 'maxconn': 3}
+    }
+    assert DB.pool().dsn == 'dbname=test'
+    assert DB.pool().maxconn == 10
+    assert DB.pool('other').dsn == 'dbname=other'
+    assert DB.pool('other').maxconn == 3
+
+
+def test_db_fetchall_reconnects_when_connection_is_lost(connect, pools,
+                                                        config):
+    config.DATABASES = {'default': 'dbname=test'}
+    DB.pool()
+    connect[0].broken = True
+    rows = DB.fetchall('SELECT 1')
+    assert rows == [('row', )]
+    assert rows.columns == ['name']
+    assert connect[0].closed
+    assert connect[1].queries == ['SELECT 1']
+
+
+def test_statement_forms():
+    statement = Statement("SELECT * FROM t WHERE name LIKE '%a' "
+                          "AND z <= !zoom! AND x > !west! AND y < !west!")
+    assert statement == ("SELECT * FROM t WHERE name LIKE '%%a' "
+                         "AND z <= %(zoom)s AND x > %(west)s "
+                         "AND y < %(west)s")
+    assert statement.prepared == ("SELECT * FROM t WHERE name LIKE '%a' "
+                                  "AND z <= $1::integer AND x > $2::float8 "
+                                  "AND y < $2::float8")
+    assert statement.params == ['zoom', 'west']
+    assert statement.name.startswith('utilery_')
+
+
+def test_db_fetchall_prepares_statements_once(connect, pools, config):
+    config.DATABASES = {'default': 'dbname=test'}
+    statement = Statement('SELECT !zoom!, !west!')
+    DB.fetchall(statement, {'zoom': 1, 'west': 2.5})
+    DB.fetchall(statement, {'zoom': 2, 'west': 2.5})
+    assert connect[0].queries == [
+        'PREPARE {} AS SELECT $1::integer, $2::float8'.format(statement.name),
+        'EXECUTE {} (%s, %s)'.format(statement.name),
+        'EXECUTE {} (%s, %s)'.format(statement.name),
+    ]
+    assert connect[0].args == [None, [1, 2.5], [2, 2.5]]
+
+
+def test_db_fetchall_can_skip_prepared_statements(connect, pools, config):
+    config.DATABASES = {'default': 'dbname=test'}
+    config.PREPARED_STATEMENTS = False
+    statement = Statement('SELECT !zoom!')
+    DB.fetchall(statement, {'zoom': 1})
+    assert connect[0].queries == ['SELECT %(zoom)s']
+
+
+def test_db_iterate_fetches_rows_by_batches(connect, pools, config):
+    config.DATABASES = {'default': 'dbname=test'}
+    pool = DB.pool()
+    conn = connect[0]
+    conn.rows = [{'id': i} for i in range(5)]
+    rows = DB.iterate('SELECT id', batch_size=2)
+    assert next(rows) == {'id': 0}
+    # Connection is held while iterating.
+    assert not pool._idle
+    assert [r['id'] for r in rows] == [1, 2, 3, 4]
+    assert conn.cursors[0].closed
+    assert pool._idle
+
+
+RECIPE = """
+name: cached
+layers:
+  - name: mylayer
+    queries:
+      - sql: SELECT geometry AS way FROM table
+"""
+
+
+def test_recipes_are_parsed_with_safe_loader(tmpdir, config):
+    config.RECIPES_CACHE = None
+    path = tmpdir.join('recipe.yml')
+    path.write(RECIPE + "\nunsafe: !!python/object/apply:os.getcwd []\n")
+    with pytest.raises(yaml.YAMLError):
+        core.parse_recipe(str(path))
+
+
+def test_recipe_snapshots(tmpdir, config, monkeypatch):
+    config.RECIPES_CACHE = str(tmpdir.join('cache'))
+    path = tmpdir.join('recipe.yml')
+    path.write(RECIPE)
+    data = core.parse_recipe(str(path))
+    assert data['layers'][0]['name'] == 'mylayer'
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    def load(*args, **kwargs):
+        assert False, 'snapshot should be used'
+    original = yaml.load
+    monkeypatch.setattr(core.yaml, 'load', load)
+    assert core.parse_recipe(str(path)) == data
+
+    # Any change of the file makes a new snapshot.
+    monkeypatch.setattr(core.yaml, 'load', original)
+    path.write(RECIPE.replace('cached', 'changed'))
+    assert core.parse_recipe(str(path))['name'] == 'changed'
+    assert len(tmpdir.join('cache').listdir()) == 2
+
+
+def test_init_loads_recipes_once(tmpdir, config, monkeypatch):
+    path = tmpdir.join('recipe.yml')
+    path.write(RECIPE)
+    config.RECIPES = [str(path)]
+    config.RECIPES_CACHE = None
+    monkeypatch.setattr(core, 'INITIALIZED', False)
+    monkeypatch.setattr(core, 'RECIPES', {})
+    monkeypatch.setattr(core.Plugins, '_hooks', {})
+    monkeypatch.setattr(core.Plugins, '_registry', [])
+    core.init()
+    core.init()
+    assert list(core.RECIPES) == ['cached', 'default']
+    assert len(core.Plugins._registry) == len(config.BUILTIN_PLUGINS +
+                                              config.PLUGINS)
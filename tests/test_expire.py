@@ -0,0 +1,98 @@
+import mercantile
+import pytest
+
+from utilery import cli
+from utilery.cache import Cache, FileCache, TileKey
+from utilery.expire import (affected, bbox_tiles, expire, parse_bbox,
+                            parse_notify)
+
+
+@pytest.fixture
+def cache(monkeypatch, tmpdir):
+    backend = FileCache(str(tmpdir.join('cache')))
+    monkeypatch.setattr(Cache, 'backend', backend)
+    return backend
+
+
+def test_affected_covers_parents_and_children():
+    tiles = affected([mercantile.Tile(2, 1, 2)], 0, 3)
+    assert tiles == {
+        mercantile.Tile(0, 0, 0),
+        mercantile.Tile(1, 0, 1),
+        mercantile.Tile(2, 1, 2),
+        mercantile.Tile(4, 2, 3), mercantile.Tile(5, 2, 3),
+        mercantile.Tile(4, 3, 3), mercantile.Tile(5, 3, 3),
+    }
+
+
+def test_affected_respects_zoom_range():
+    tiles = affected([mercantile.Tile(2, 1, 2)], 1, 1)
+    assert tiles == {mercantile.Tile(1, 0, 1)}
+
+
+def test_affected_leaves_out_zooms_over_limit():
+    tiles = affected([mercantile.Tile(2, 1, 2)], 0, 4, limit=10)
+    assert len(tiles) == 7
+    assert max(tile.z for tile in tiles) == 3
+
+
+def test_bbox_tiles_leaves_out_zooms_over_limit():
+    tiles = bbox_tiles([-180, -85, 180, 85], 0, 18, limit=100)
+    assert len(tiles) == 1 + 4 + 16 + 64
+
+
+def test_parse_bbox():
+    assert parse_bbox('-1,-2,3,4') == [-1, -2, 3, 4]
+    assert parse_bbox('-1 -2 3 4') == [-1, -2, 3, 4]
+    with pytest.raises(ValueError):
+        parse_bbox('1,2,3')
+
+
+def test_parse_notify():
+    assert parse_notify('1/0/0', 0, 1) == {mercantile.Tile(0, 0, 0),
+                                           mercantile.Tile(0, 0, 1)}
+    assert parse_notify('-1,-1,1,1', 0, 1) == bbox_tiles([-1, -1, 1, 1], 0, 1)
+
+
+def test_expire_list_purges_cache(cache, tmpdir):
+    for z, x, y in [(0, 0, 0), (1, 0, 0), (1, 1, 0), (2, 0, 0)]:
+        cache.set(TileKey('default', 'all', z, x, y, 'pbf'), b'tile')
+        cache.set(TileKey('default', 'all', z, x, y, 'pbf.gz'), b'tile')
+    path = tmpdir.join('expire.list')
+    path.write('2/0/0\n')
+    cli.main(['expire', str(path), '--maxzoom', '2'])
+    assert cache.get(TileKey('default', 'all', 0, 0, 0, 'pbf')) is None
+    assert cache.get(TileKey('default', 'all', 1, 0, 0, 'pbf.gz')) is None
+    assert cache.get(TileKey('default', 'all', 2, 0, 0, 'pbf')) is None
+    assert cache.get(TileKey('default', 'all', 1, 1, 0, 'pbf')) == b'tile'
+
+
+def test_expire_can_render_again(cache, fetchall, tmpdir):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    key = TileKey('default', 'all', 0, 0, 0, 'pbf')
+    cache.set(key, b'outdated')
+    path = tmpdir.join('expire.list')
+    path.write('0/0/0\n')
+    cli.main(['expire', str(path), '--maxzoom', '0', '--render'])
+    assert cache.get(key) not in (None, b'outdated')
+
+
+def test_expire_renders_at_most_max_render_tiles(cache, fetchall):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    expire(affected([mercantile.Tile(0, 0, 0)], 0, 1), ['default'],
+           render=True, max_render=3)
+    rendered = [tile for tile in bbox_tiles([-180, -85, 180, 85], 0, 1)
+                if cache.exists(TileKey('default', 'all', tile.z, tile.x,
+                                        tile.y, 'pbf'))]
+    assert len(rendered) == 3
+    assert mercantile.Tile(0, 0, 0) in rendered
+
+
+def test_expire_needs_a_shared_cache(monkeypatch, tmpdir, capsys):
+    from utilery.cache import MemoryCache
+    monkeypatch.setattr(Cache, 'backend', MemoryCache())
+    path = tmpdir.join('expire.list')
+    path.write('0/0/0\n')
+    with pytest.raises(SystemExit):
+        cli.main(['expire', str(path)])
+    assert 'not shared between processes' in capsys.readouterr().err
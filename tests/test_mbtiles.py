@@ -0,0 +1,162 @@
+import json
+import time
+
+import mercantile
+import pytest
+
+from utilery.mbtiles import MBTiles
+from utilery.seed import MBTilesWriter, seed
+
+
+@pytest.fixture
+def mbtiles(tmpdir):
+    mbtiles = MBTiles(str(tmpdir.join('test.mbtiles')))
+    mbtiles.create()
+    return mbtiles
+
+
+def test_write_and_read_tiles(mbtiles):
+    mbtiles.write(1, 0, 0, b'tile')
+    mbtiles.flush()
+    assert mbtiles.read(1, 0, 0) == b'tile'
+    assert mbtiles.read(1, 0, 1) is None
+    # Rows are stored in TMS scheme.
+    row = mbtiles.db.execute('SELECT tile_row FROM map').fetchone()[0]
+    assert row == 1
+
+
+def test_writes_are_batched(mbtiles):
+    mbtiles.batch_size = 2
+    mbtiles.write(1, 0, 0, b'tile')
+    assert not mbtiles.exists(1, 0, 0)
+    mbtiles.write(1, 0, 1, b'tile')
+    assert mbtiles.exists(1, 0, 0)
+
+
+def test_identical_tiles_are_stored_once(mbtiles):
+    mbtiles.write(1, 0, 0, b'empty')
+    mbtiles.write(1, 0, 1, b'empty')
+    mbtiles.write(1, 1, 1, b'other')
+    mbtiles.flush()
+    assert mbtiles.db.execute('SELECT COUNT(*) FROM map').fetchone()[0] == 3
+    count = mbtiles.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+    assert count == 2
+
+
+def test_identical_tiles_written_at_different_times_are_stored_once(
+        mbtiles, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1000.0)
+    mbtiles.write(1, 0, 0, b'empty')
+    mbtiles.flush()
+    monkeypatch.setattr(time, 'time', lambda: 1001.5)
+    mbtiles.write(1, 0, 1, b'empty')
+    mbtiles.flush()
+    count = mbtiles.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+    assert count == 1
+    assert mbtiles.read(1, 0, 1) == b'empty'
+
+
+def test_close_removes_orphan_images(mbtiles):
+    mbtiles.write(1, 0, 0, b'old')
+    mbtiles.flush()
+    mbtiles.write(1, 0, 0, b'new')
+    mbtiles.close()
+    count = mbtiles.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+    assert count == 1
+    assert mbtiles.read(1, 0, 0) == b'new'
+
+
+def test_contains_uses_seeded_coverage(mbtiles):
+    mbtiles.cover([0, 0, 10, 10], 1, 2)
+    assert mbtiles.contains(mercantile.Tile(1, 0, 1))
+    assert not mbtiles.contains(mercantile.Tile(0, 0, 1))
+    assert not mbtiles.contains(mercantile.Tile(0, 0, 0))
+    assert not mbtiles.contains(mercantile.Tile(0, 0, 3))
+    mbtiles.fail(1, 1, 0)
+    assert not mbtiles.contains(mercantile.Tile(1, 0, 1))
+    # Seeded again.
+    mbtiles.write(1, 1, 0, b'tile')
+    mbtiles.flush()
+    assert mbtiles.contains(mercantile.Tile(1, 0, 1))
+
+
+def test_coverage_is_not_widened_by_other_areas(mbtiles):
+    mbtiles.cover([0, 0, 1, 1], 0, 1)
+    mbtiles.cover([100, 10, 101, 11], 5, 5)
+    assert not mbtiles.contains(mercantile.Tile(5, 3, 3))
+    assert mbtiles.contains(mercantile.Tile(1, 0, 1))
+    assert mbtiles.contains(next(mercantile.tiles(100, 10, 101, 11, [5])))
+
+
+def test_seed_into_mbtiles(fetchall, tmpdir):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    path = str(tmpdir.join('seed.mbtiles'))
+    seed(MBTilesWriter(path, 'default', [-1, -1, 1, 1], 0, 1),
+         [-1, -1, 1, 1], 0, 1)
+    mbtiles = MBTiles(path)
+    assert mbtiles.zooms == (0, 1)
+    assert mbtiles.bounds == [-1, -1, 1, 1]
+    assert mbtiles.metadata['format'] == 'pbf'
+    assert mbtiles.read(1, 1, 1)
+
+
+def test_seed_errors_are_not_covered(fetchall, tmpdir, monkeypatch):
+    from utilery import seed as module
+    monkeypatch.setattr(module, 'render', lambda job: [
+        (tile, None, 'boom') for tile in job[0]])
+    path = str(tmpdir.join('seed.mbtiles'))
+    stats = seed(MBTilesWriter(path, 'default', [-1, -1, 1, 1], 0, 0),
+                 [-1, -1, 1, 1], 0, 0)
+    assert stats['errors'] == 1
+    assert not MBTiles(path).contains(mercantile.Tile(0, 0, 0))
+
+
+def test_serve_from_mbtiles(client, fetchall, config, mbtiles):
+    mbtiles.write(1, 0, 0, b'from mbtiles')
+    mbtiles.cover([-180, 0, 0, 85], 0, 1)
+    mbtiles.close()
+    config.MBTILES = {'default': mbtiles.path}
+    calls = []
+    fetchall([], lambda *args, **kwargs: calls.append(1))
+    resp = client.get('/all/1/0/0.pbf')
+    assert resp.data == b'from mbtiles'
+    # Missing tiles covered by the file are empty tiles.
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    assert resp.data == b''
+    assert not calls
+    # Fallback to the database outside of the seeded area.
+    client.get('/all/2/0/0.pbf')
+    client.get('/all/1/1/1.pbf')
+    assert len(calls) == 2
+
+
+def test_tilejson_advertises_mbtiles_metadata(client, config, mbtiles):
+    mbtiles.set_metadata(minzoom=0, maxzoom=8, bounds='-5,41,9,51')
+    config.MBTILES = {'default': mbtiles.path}
+    resp = client.get('/tilejson/mvt.json')
+    data = json.loads(resp.data.decode())
+    assert data['bounds'] == [-5, 41, 9, 51]
+    assert data['minzoom'] == 0
+    assert data['maxzoom'] == 8
+
+
+def test_gzipped_tiles_are_sent_as_is(client, config, mbtiles):
+    mbtiles.write(0, 0, 0, b'from mbtiles')
+    mbtiles.close()
+    config.MBTILES = {'default': mbtiles.path}
+    resp = client.get('/all/0/0/0.pbf', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.data == mbtiles.db.execute(
+        'SELECT tile_data FROM images').fetchone()[0]
+
+
+def test_missing_mbtiles_are_not_created(client, fetchall, config, tmpdir):
+    path = tmpdir.join('missing.mbtiles')
+    config.MBTILES = {'default': str(path)}
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    assert client.get('/tilejson/mvt.json').status_code == 200
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    assert resp.data
+    assert not path.exists()
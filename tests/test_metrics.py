@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from utilery import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics.Metric, 'registry', [])
+
+
+def test_counter_exposition(registry):
+    counter = metrics.Counter('hits_total', 'Hits.', ['recipe'])
+    counter.inc(recipe='default')
+    counter.inc(2, recipe='default')
+    counter.inc(recipe='with "quotes"')
+    assert metrics.expose() == (
+        '# HELP hits_total Hits.\n'
+        '# TYPE hits_total counter\n'
+        'hits_total{recipe="default"} 3\n'
+        'hits_total{recipe="with \\"quotes\\""} 1\n')
+
+
+def test_histogram_exposition(registry):
+    histogram = metrics.Histogram('duration_seconds', 'Duration.', ['zoom'],
+                                  buckets=[0.1, 1])
+    histogram.observe(0.05, zoom=1)
+    histogram.observe(0.5, zoom=1)
+    histogram.observe(5, zoom=1)
+    assert histogram.get(zoom=1) == (5.55, 3)
+    assert metrics.expose().splitlines()[2:] == [
+        'duration_seconds_bucket{zoom="1",le="0.1"} 1',
+        'duration_seconds_bucket{zoom="1",le="1.0"} 2',
+        'duration_seconds_bucket{zoom="1",le="+Inf"} 3',
+        'duration_seconds_sum{zoom="1"} 5.55',
+        'duration_seconds_count{zoom="1"} 3',
+    ]
+
+
+def test_timings_are_exclusive():
+    timings = metrics.Timings()
+    with timings('encode', 'mylayer'):
+        time.sleep(0.02)
+        with timings('db', 'mylayer'):
+            time.sleep(0.05)
+    assert 0.02 <= timings.totals['encode', 'mylayer'] < 0.05
+    assert timings.totals['db', 'mylayer'] >= 0.05
+
+
+def test_metrics_endpoint(client, fetchall, cache):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}] * 2)
+    features = metrics.FEATURES.get(recipe='default', layer='mylayer',
+                                    zoom=3)
+    hits = metrics.CACHE_HITS.get(recipe='default', format='pbf')
+    client.get('/all/3/1/2.pbf')
+    client.get('/all/3/1/2.pbf')
+    assert metrics.FEATURES.get(recipe='default', layer='mylayer',
+                                zoom=3) == features + 2
+    assert metrics.CACHE_HITS.get(recipe='default', format='pbf') == hits + 1
+    for stage in ('db', 'convert', 'encode'):
+        assert metrics.STAGE_SECONDS.get(recipe='default', layer='mylayer',
+                                         zoom=3, stage=stage)[1]
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    assert 'utilery_tile_seconds_bucket{recipe="default",format="pbf",' \
+        'zoom="3",le="0.005"}' in resp.data.decode()
+
+
+def test_errors_are_counted(client):
+    errors = metrics.ERRORS.get(recipe='default', format='pbf', status=400)
+    client.get('/unknown/0/0/0.pbf')
+    assert metrics.ERRORS.get(recipe='default', format='pbf',
+                              status=400) == errors + 1
+
+
+def test_unknown_recipes_do_not_add_series(client, cache, monkeypatch):
+    def get_stale(key):
+        assert False, 'cache should not be looked up'
+    monkeypatch.setattr(cache, 'get_stale', get_stale)
+    series = len(metrics.ERRORS._values), len(metrics.CACHE_MISSES._values)
+    errors = metrics.ERRORS.get(recipe='_unknown', format='pbf', status=400)
+    for i in range(5):
+        resp = client.get('/nope{}/all/0/0/0.pbf'.format(i))
+        assert resp.status_code == 400
+    assert metrics.ERRORS.get(recipe='_unknown', format='pbf',
+                              status=400) == errors + 5
+    assert len(metrics.ERRORS._values) <= series[0] + 1
+    assert len(metrics.CACHE_MISSES._values) == series[1]
+
+
+def test_metrics_can_be_disabled(client, config):
+    config.METRICS = False
+    assert client.get('/metrics').status_code == 404
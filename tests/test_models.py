@@ -1,4 +1,6 @@
-from utilery.models import Recipe, Layer, Query
+import pytest
+
+from utilery.models import Columns, Feature, Layer, Query, Recipe
 
 
 def test_basic_recipe():
@@ -34,3 +36,36 @@ def test_query_inherit_from_parents():
     assert query.buffer == 128
     assert query.srid == 3857
     assert query.unknown is None
+
+
+def test_columns_skip_private_columns_and_way():
+    columns = Columns(['_way', 'way', 'name', '_rank', 'type'])
+    assert columns.geometry == 0
+    assert columns.properties == ('name', 'type')
+    row = (b'wkb', b'raw', 'foo', 3, 'park')
+    assert columns.to_properties(row) == {'name': 'foo', 'type': 'park'}
+
+
+def test_columns_with_one_or_no_property():
+    row = ('POINT(0 0)', 'foo')
+    assert Columns(['_way', 'name']).to_properties(row) == {'name': 'foo'}
+    assert Columns(['_way', '_name']).to_properties(row) == {}
+
+
+def test_columns_of_rows_without_description():
+    row = {'_way': 'POINT(0 0)', 'name': 'foo'}
+    columns = Columns.of([row], row)
+    assert columns.to_tuple(row) == ('POINT(0 0)', 'foo')
+    assert columns.properties == ('name', )
+
+
+def test_feature_behaves_like_a_mapping_for_encoders():
+    feature = Feature('POINT(0 0)', {'name': 'foo'})
+    assert feature.get('geometry') == 'POINT(0 0)'
+    assert feature.get('id') is None
+    assert feature['properties'] == {'name': 'foo'}
+    feature['geometry'] = 'POINT(1 1)'
+    assert feature.as_dict() == {'geometry': 'POINT(1 1)',
+                                 'properties': {'name': 'foo'}}
+    with pytest.raises(KeyError):
+        feature['id']
@@ -0,0 +1,72 @@
+import mapbox_vector_tile
+import pytest
+import shapely.geometry
+
+from utilery.models import Feature
+from utilery.mvt import LayerEncoder
+
+
+def features():
+    return [
+        Feature('POINT(10 20)', {'name': 'foo', 'rank': 1, 'area': 1.5}),
+        Feature(shapely.geometry.LineString([(0, 0), (10, 10)]).wkb,
+                {'name': 'bar', 'rank': -3, 'is_link': True, 'nope': None}),
+        # Clockwise, so its winding order gets fixed.
+        Feature('POLYGON((0 0, 0 10, 10 10, 10 0, 0 0))',
+                {'name': 'foo', 'rank': 1, 'is_link': False}),
+        Feature('MULTIPOINT(1 1, 2 2)', {}),
+        Feature(None, {'name': 'no geometry'}),
+        Feature('POINT EMPTY', {'name': 'empty'}),
+    ]
+
+
+def test_same_output_as_mapbox_vector_tile():
+    expected = mapbox_vector_tile.encode([{'name': 'mylayer',
+                                           'features': features()}])
+    assert LayerEncoder('mylayer').encode(features()) == expected
+
+
+def test_values_of_different_types_are_distinct():
+    data = [Feature('POINT(0 0)', {'a': 1, 'b': 1.0, 'c': True})]
+    tile = mapbox_vector_tile.decode(LayerEncoder('mylayer').encode(data))
+    properties = tile['mylayer']['features'][0]['properties']
+    assert properties == {'a': 1, 'b': 1.0, 'c': True}
+    assert isinstance(properties['b'], float)
+    assert properties['c'] is True
+
+
+def test_unsupported_values_are_skipped():
+    data = [Feature('POINT(0 0)', {'tags': [1, 2], 'extra': {'a': 1},
+                                   'name': 'foo'})]
+    tile = mapbox_vector_tile.decode(LayerEncoder('mylayer').encode(data))
+    assert tile['mylayer']['features'][0]['properties'] == {'name': 'foo'}
+    assert LayerEncoder('mylayer').encode(data) == mapbox_vector_tile.encode(
+        [{'name': 'mylayer', 'features': data}])
+
+
+def test_empty_layer():
+    assert LayerEncoder('mylayer').encode([]) == mapbox_vector_tile.encode(
+        [{'name': 'mylayer', 'features': []}])
+
+
+def test_keys_and_values_are_interned_across_tiles(monkeypatch):
+    monkeypatch.setattr(LayerEncoder, 'MAX_INTERNED', 2)
+    encoder = LayerEncoder('mylayer')
+    first = encoder.encode(features())
+    assert len(encoder.keys) == 2
+    assert len(encoder.values) == 2
+    # Tables are indexed per tile: the second one is the same.
+    assert encoder.encode(features()) == first
+    tile = mapbox_vector_tile.decode(encoder.encode(features()[3:4]))
+    assert tile['mylayer']['features'][0]['properties'] == {}
+
+
+def test_unknown_geometry():
+    with pytest.raises(ValueError):
+        LayerEncoder('mylayer').encode([Feature(123, {})])
+
+
+def test_geometry_collections_are_not_supported():
+    feature = Feature('GEOMETRYCOLLECTION(POINT(0 0))', {})
+    with pytest.raises(ValueError):
+        LayerEncoder('mylayer').encode([feature])
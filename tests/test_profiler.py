@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from utilery.profiler import SlowQueries
+
+
+@pytest.fixture
+def slow_queries(config, monkeypatch):
+    SlowQueries.clear()
+    monkeypatch.setattr('utilery.profiler.random.random', lambda: 0.5)
+    config.SLOW_QUERIES = {'threshold': 0}
+    yield config
+    SlowQueries.clear()
+
+
+def test_slow_queries_are_recorded(client, fetchall, slow_queries):
+    fetchall([])
+    client.get('/all/3/1/2.pbf')
+    entry, = SlowQueries.query()
+    assert entry['layer'] == 'mylayer'
+    assert (entry['zoom'], entry['x'], entry['y']) == (3, 1, 2)
+    assert 'ST_Intersects' in entry['sql']
+    assert entry['params']['zoom'] == 3
+    assert entry['plan'] is None
+
+
+def test_fast_queries_are_not_recorded(client, fetchall, slow_queries):
+    slow_queries.SLOW_QUERIES = {'threshold': 10}
+    fetchall([])
+    client.get('/all/0/0/0.pbf')
+    assert SlowQueries.query() == []
+
+
+def test_slow_queries_are_sampled_for_explain(client, monkeypatch,
+                                              slow_queries):
+    slow_queries.SLOW_QUERIES = {'threshold': 0, 'explain': 0.6}
+    queries = []
+
+    def fetchall(query, args=None, dbname=None):
+        queries.append(query)
+        if query.startswith('EXPLAIN'):
+            return [[[{'Plan': {'Node Type': 'Seq Scan'}}]]]
+        return []
+
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+    client.get('/all/0/0/0.pbf')
+    SlowQueries.executor().submit(lambda: None).result()
+    assert queries[1].startswith('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ')
+    entry, = SlowQueries.query()
+    assert entry['plan'] == [{'Plan': {'Node Type': 'Seq Scan'}}]
+
+
+def test_debug_endpoint_filters_entries(client, fetchall, slow_queries):
+    fetchall([])
+    client.get('/all/0/0/0.pbf')
+    client.get('/all/1/0/0.pbf')
+    resp = client.get('/debug/slow-queries?zoom=1')
+    entries = json.loads(resp.data.decode())
+    assert [(e['zoom'], e['layer']) for e in entries] == [(1, 'mylayer')]
+
+
+def test_debug_endpoint_needs_slow_queries(client):
+    assert client.get('/debug/slow-queries').status_code == 404
+
+
+def test_store_is_bounded(client, fetchall, slow_queries):
+    slow_queries.SLOW_QUERIES = {'threshold': 0, 'size': 2}
+    fetchall([])
+    for x in range(4):
+        client.get('/all/2/{}/0.pbf'.format(x))
+    assert sorted(e['x'] for e in SlowQueries.query()) == [2, 3]
@@ -0,0 +1,104 @@
+import gzip
+
+import mercantile
+import shapely.geometry
+
+from utilery import cli
+from utilery.cache import FileCache, TileKey
+from utilery.seed import CacheWriter, blocks, seed, tiles
+
+
+def test_tiles_covers_bbox_for_each_zoom():
+    found = list(tiles([-1, -1, 1, 1], 0, 2))
+    assert len(found) == 1 + 4 + 4
+    assert found[0].z == 0
+
+
+def test_seed_writes_tiles_in_output(fetchall, tmpdir):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    cli.main(['seed', '--output', str(tmpdir), '--maxzoom', '1',
+              '--processes', '1'])
+    cache = FileCache(str(tmpdir))
+    assert cache.get(TileKey('default', 'all', 0, 0, 0, 'pbf'))
+    assert cache.get(TileKey('default', 'all', 1, 1, 1, 'pbf'))
+
+
+def test_seed_can_use_several_processes(fetchall, tmpdir):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    writer = CacheWriter(FileCache(str(tmpdir)), 'default', 'all')
+    stats = seed(writer, [-180, -85, 180, 85], 0, 2, processes=2)
+    assert stats['rendered'] == 21
+
+
+def test_seed_skips_empty_tiles(fetchall, tmpdir):
+    fetchall([])
+    writer = CacheWriter(FileCache(str(tmpdir)), 'default', 'all')
+    stats = seed(writer, [-1, -1, 1, 1], 0, 0)
+    assert stats == {'rendered': 0, 'skipped': 0, 'empty': 1, 'errors': 0}
+    assert not writer.exists(next(tiles([-1, -1, 1, 1], 0, 0)))
+    stats = seed(writer, [-1, -1, 1, 1], 0, 0, keep_empty=True)
+    assert stats['rendered'] == 1
+
+
+def test_seed_resumes(fetchall, tmpdir):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    writer = CacheWriter(FileCache(str(tmpdir)), 'default', 'all')
+    seed(writer, [-1, -1, 1, 1], 0, 0)
+    stats = seed(writer, [-1, -1, 1, 1], 0, 1)
+    assert stats['skipped'] == 1
+    assert stats['rendered'] == 4
+    stats = seed(writer, [-1, -1, 1, 1], 0, 1, resume=False)
+    assert stats['rendered'] == 5
+
+
+def test_seed_reports_errors(fetchall, tmpdir):
+    writer = CacheWriter(FileCache(str(tmpdir)), 'default', 'all')
+    stats = seed(writer, [-1, -1, 1, 1], 0, 0, recipe='unknown')
+    assert stats['errors'] == 1
+
+
+def test_seed_renders_metatiles_at_once(fetchall, layer, tmpdir):
+    layer.recipe['metatile'] = 2
+    calls = []
+    point = shapely.geometry.Point(1000, 1000)
+    fetchall([{'_way': point.wkb, 'name': 'foo'}],
+             lambda *args, **kwargs: calls.append(1))
+    writer = CacheWriter(FileCache(str(tmpdir)), 'default', 'all')
+    stats = seed(writer, [-180, -85, 180, 85], 0, 2, keep_empty=True)
+    assert stats['rendered'] == 21
+    # One query for zoom 0, one for zoom 1 and four for zoom 2.
+    assert len(calls) == 6
+
+
+def test_blocks_are_grouped_lazily(layer):
+    layer.recipe['metatile'] = 2
+    consumed = []
+
+    def stream():
+        for tile in tiles([-180, -85, 180, 85], 0, 12):
+            consumed.append(tile)
+            yield tile
+
+    found = blocks(stream(), 'all', 'default')
+    assert next(found) == [mercantile.Tile(0, 0, 0)]
+    assert next(found) == [mercantile.Tile(0, 0, 1), mercantile.Tile(0, 1, 1),
+                           mercantile.Tile(1, 0, 1), mercantile.Tile(1, 1, 1)]
+    assert len(next(found)) == 4
+    # Only the first column of metatiles of zoom 2 has been read.
+    assert len(consumed) < 20
+
+
+def test_seeded_tiles_are_served_compressed(fetchall, cache, client, config):
+    config.COMPRESSION = {'pbf': {'gzip': 6}}
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    seed(CacheWriter(cache, 'default', 'all'), [-1, -1, 1, 1], 0, 0)
+    assert cache.get(TileKey('default', 'all', 0, 0, 0, 'pbf.gz'))
+
+    def fail(*args, **kwargs):
+        assert False, 'tile should be served from the cache'
+    fetchall(None, fail)
+    resp = client.get('/all/0/0/0.pbf', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    plain = cache.get(TileKey('default', 'all', 0, 0, 0, 'pbf'))
+    assert gzip.decompress(resp.data) == plain
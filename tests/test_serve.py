@@ -0,0 +1,95 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+from utilery import serve
+from utilery.cache import SingleFlight
+from utilery.core import DB
+from utilery.views import ServeTile
+
+
+def app(environ, start_response):
+    start_response('200 OK', [])
+    return [b'ok']
+
+
+def test_worker_counts_requests():
+    worker = serve.Worker(app, None, max_requests=2)
+    assert worker({}, lambda *args: None) == [b'ok']
+    assert worker.recycle is None
+    worker({}, lambda *args: None)
+    assert worker.recycle == 'served 2 requests'
+
+
+def test_worker_recycled_above_max_memory(monkeypatch):
+    worker = serve.Worker(app, None, max_memory=2 ** 20)
+    monkeypatch.setattr(serve, 'memory', lambda: 2 ** 19)
+    assert worker.recycle is None
+    monkeypatch.setattr(serve, 'memory', lambda: 2 ** 21)
+    assert worker.recycle == 'uses more than 1048576 bytes'
+
+
+def test_memory():
+    assert serve.memory() > 0
+
+
+def test_per_process_state_is_reset_after_fork(monkeypatch):
+    monkeypatch.setattr(DB, '_', {'default': 'parent pool'})
+    flights = ServeTile.flights
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        reset = DB._ == {} and ServeTile.flights is not flights \
+            and isinstance(ServeTile.flights, SingleFlight) \
+            and ServeTile._executor is None
+        os.write(write, b'1' if reset else b'0')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b'1'
+    assert DB._ == {'default': 'parent pool'}
+    assert ServeTile.flights is flights
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_serve_command_recycles_workers():
+    root = Path(__file__).parent.parent
+    port = free_port()
+    env = dict(os.environ,
+               UTILERY_SETTINGS=str(root / 'utilery/config/test.py'))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'utilery.cli', 'serve', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', '2', '--max-requests', '2'],
+        cwd=str(root), env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:{}/tilejson/mvt.json'.format(port)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                urllib.request.urlopen(url, timeout=5)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(.1)
+        statuses = [urllib.request.urlopen(url, timeout=5).status
+                    for i in range(8)]
+        assert statuses == [200] * 8
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        output = proc.communicate(timeout=30)[0].decode()
+    assert proc.returncode == 0
+    assert 'Recycling worker' in output
@@ -1,5 +1,15 @@
+import datetime
+import gzip
 import json
+import threading
+import time
 
+import mapbox_vector_tile
+import shapely.geometry
+import shapely.wkb
+import yaml
+
+from utilery.core import Rows
 from utilery.models import Layer, Recipe
 from .utils import copy
 
@@ -144,6 +154,34 @@ def test_add_buffer_when_asked(client, fetchall, layer):
     assert client.get('/all/0/0/0.pbf')
 
 
+def test_simplify_when_asked(client, fetchall, layer):
+
+    layer['simplify'] = 2
+    layer['clip'] = True
+    queries = []
+    fetchall([], lambda query, *args, **kwargs: queries.append(query))
+
+    assert client.get('/all/0/0/0.json').status_code == 200
+    assert 'ST_Transform(ST_SimplifyPreserveTopology(ST_Intersection(way, ' \
+        in queries[0]
+    assert '), 2.0 * %(pixel_width)s), 4326)' in queries[0]
+
+
+def test_snap_to_grid_and_min_area_when_asked(client, fetchall, layer):
+
+    layer['snap_to_grid'] = True
+    layer['min_area_pixels'] = 4
+    layer['scale'] = 2
+    queries = []
+    fetchall([], lambda query, *args, **kwargs: queries.append(query))
+
+    assert client.get('/all/0/0/0.json').status_code == 200
+    assert 'ST_SnapToGrid(way, 1.0 * (%(pixel_width)s / 2))' in queries[0]
+    assert queries[0].endswith(
+        ' AND (ST_Dimension(way) < 2 OR '
+        'ST_Area(way) >= 4.0 * (%(pixel_width)s / 2) ^ 2)')
+
+
 def test_tilejson(client, config):
     config.TILEJSON['name'] = "testname"
     resp = client.get('/tilejson/mvt.json')
@@ -152,3 +190,454 @@ def test_tilejson(client, config):
     assert data['name'] == "testname"
     assert "vector_layers" in data
     assert data['vector_layers'][0]['id'] == 'default:mylayer'
+
+
+def test_parallel_queries_keep_recipe_order(client, monkeypatch, recipes,
+                                            config):
+    config.PARALLEL_QUERIES = 4
+    recipes['default'] = Recipe({
+        'name': 'default',
+        'layers': [{
+            'name': name,
+            'queries': [{'sql': 'SELECT {} AS way'.format(name)}]
+        } for name in ('slow', 'fast')]
+    })
+    threads = set()
+
+    def fetchall(query, *args, **kwargs):
+        threads.add(threading.current_thread())
+        if 'slow' in query:
+            time.sleep(0.05)
+        name = 'slow' if 'slow' in query else 'fast'
+        return [{'_way': '{"type": "Point", "coordinates": [0, 0]}',
+                 'name': name}]
+
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+
+    resp = client.get('/all/0/0/0.json')
+    assert resp.status_code == 200
+    data = json.loads(resp.data.decode())
+    assert [layer['name'] for layer in data] == ['slow', 'fast']
+    assert data[0]['features'][0]['properties']['name'] == 'slow'
+    assert threading.current_thread() not in threads
+
+
+def test_tiles_are_served_from_cache(client, fetchall, cache):
+    calls = []
+    fetchall([], lambda *args, **kwargs: calls.append(1))
+    first = client.get('/mylayer/0/0/0.pbf')
+    second = client.get('/mylayer/0/0/0.pbf')
+    assert second.status_code == 200
+    assert second.data == first.data
+    assert len(calls) == 1
+    client.get('/mylayer/0/0/0.json')
+    assert len(calls) == 2
+
+
+def test_postgis_engine_builds_one_query_per_tile(client, monkeypatch,
+                                                  recipes):
+    recipe = Recipe(copy(recipes['default']))
+    layer = Layer(recipe, copy(recipes['default'].layers['mylayer']))
+    layer['name'] = 'other'
+    recipe.layers['other'] = layer
+    recipe['engine'] = 'postgis'
+    recipe['buffer'] = 4
+    recipes['default'] = recipe
+    monkeypatch.setattr('utilery.views.ServePBF._mvt_support', {})
+    queries = []
+
+    def fetchall(query, *args, **kwargs):
+        queries.append(query)
+        if 'pg_proc' in query:
+            return [[1]]
+        if 'LIMIT 0' in query:
+            return Rows([], ['way', 'type', '_rank', 'name'])
+        return [[memoryview(b'mvt')]]
+
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    assert resp.data == b'mvt'
+    # Support check, then the columns of each query, then the tile.
+    assert len(queries) == 4
+    assert queries[3].count('ST_AsMVT(') == 2
+    assert "'mylayer'" in queries[3]
+    assert "'other'" in queries[3]
+    assert ', 4096, 64, false)' in queries[3]
+    assert 'AS _geom, data."type", data."name" FROM' in queries[3]
+    assert 'jsonb' not in queries[3]
+    queries.clear()
+    assert client.get('/all/0/0/0.pbf').status_code == 200
+    assert len(queries) == 1
+
+
+def test_postgis_engine_falls_back_to_python(client, monkeypatch, layer):
+    layer.recipe['engine'] = 'postgis'
+    monkeypatch.setattr('utilery.views.ServePBF._mvt_support', {})
+    queries = []
+
+    def fetchall(query, *args, **kwargs):
+        queries.append(query)
+        return []
+
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    assert len(queries) == 2
+    assert 'ST_AsMVT' not in queries[1]
+
+
+def test_tile_values_are_sent_as_parameters(client, fetchall, layer):
+
+    def check_query(query, params, *args, **kwargs):
+        assert '%(zoom)s' in query
+        assert params['zoom'] == 3
+        assert params['west'] == -15028131.257091932
+
+    layer.queries[0]['sql'] = 'SELECT * FROM foo WHERE zoom = !zoom!'
+    fetchall([], check_query)
+
+    assert client.get('/all/3/1/2.pbf').status_code == 200
+
+
+def test_pbf_geometries_are_fetched_as_wkb(client, fetchall):
+
+    def check_query(query, *args, **kwargs):
+        assert 'ST_AsBinary(ST_SnapToGrid(' in query
+        assert 'ST_AsText' not in query
+
+    wkb = memoryview(shapely.wkb.dumps(shapely.geometry.Point(10, 20)))
+    fetchall([{'_way': wkb, 'name': 'foo'}], check_query)
+
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    tile = mapbox_vector_tile.decode(resp.data)
+    feature = tile['mylayer']['features'][0]
+    assert feature['geometry']['coordinates'] == [10, 20]
+    assert feature['properties'] == {'name': 'foo'}
+
+
+def test_full_resolution_way_is_not_fetched(client, fetchall, layer):
+    queries = []
+    wkb = memoryview(shapely.wkb.dumps(shapely.geometry.Point(10, 20)))
+    fetchall(Rows([(wkb, b'raw', 'foo', 1)], ['_way', 'way', 'name', '_id']),
+             lambda query, *args, **kwargs: queries.append(query))
+    client.get('/all/0/0/0.pbf')
+    # Columns are not known before the first result.
+    assert ', * FROM' in queries[0]
+
+    fetchall(Rows([(wkb, 'foo')], ['_way', 'name']),
+             lambda query, *args, **kwargs: queries.append(query))
+    resp = client.get('/all/1/0/0.pbf')
+    assert ' as _way, data."name" FROM (' in queries[1]
+    assert '"way"' not in queries[1]
+    tile = mapbox_vector_tile.decode(resp.data)
+    assert tile['mylayer']['features'][0]['properties'] == {'name': 'foo'}
+    fetchall(Rows([('{"type": "Point", "coordinates": [1, 2]}', 'foo')],
+                  ['_way', 'name']),
+             lambda query, *args, **kwargs: queries.append(query))
+    assert client.get('/all/0/0/0.json').status_code == 200
+    assert ' as _way, data."name" FROM (' in queries[2]
+
+
+def test_streamed_queries_use_server_side_cursors(client, monkeypatch,
+                                                  layer):
+    layer['stream'] = True
+    rows = [{'_way': 'POINT(0 0)', 'name': 'foo'}] * 3
+
+    def iterate(query, args=None, dbname=None, batch_size=None):
+        assert '%(west)s' in query
+        assert batch_size == 1000
+        yield from rows
+
+    def fetchall(*args, **kwargs):
+        assert False, 'fetchall should not be called'
+
+    monkeypatch.setattr('utilery.core.DB.iterate', iterate)
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    tile = mapbox_vector_tile.decode(resp.data)
+    assert len(tile['mylayer']['features']) == 3
+
+
+def test_max_features_per_layer(client, fetchall, layer):
+    layer['max_features'] = 2
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}] * 3)
+
+    resp = client.get('/all/0/0/0.pbf')
+    tile = mapbox_vector_tile.decode(resp.data)
+    assert len(tile['mylayer']['features']) == 2
+
+
+def test_max_bytes_per_tile(client, fetchall, layer):
+    layer.recipe['max_bytes'] = 25
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}] * 3)
+
+    resp = client.get('/all/0/0/0.pbf')
+    tile = mapbox_vector_tile.decode(resp.data)
+    assert len(tile['mylayer']['features']) == 2
+
+
+def test_tiles_have_validators(client, fetchall):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.headers['ETag']
+    assert 'Last-Modified' not in resp.headers
+    assert 'Cache-Control' not in resp.headers
+    resp = client.get('/all/0/0/0.pbf',
+                      headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+
+def test_last_modified_only_comes_from_the_recipe(client, fetchall, layer):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    # Data changed since the process started, the tile must be sent.
+    since = 'Fri, 01 Jan 2100 00:00:00 GMT'
+    resp = client.get('/all/0/0/0.pbf', headers={'If-Modified-Since': since})
+    assert resp.status_code == 200
+    assert resp.data
+    layer.recipe['last_modified'] = datetime.datetime(2010, 1, 1)
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.headers['Last-Modified'] == 'Fri, 01 Jan 2010 00:00:00 GMT'
+    resp = client.get('/all/0/0/0.pbf', headers={'If-Modified-Since': since})
+    assert resp.status_code == 304
+
+
+def test_last_modified_from_yaml(client, fetchall, recipes):
+    data = copy(recipes['default'])
+    data.update(yaml.safe_load('last_modified: 2020-01-02'))
+    recipes['default'] = Recipe(data)
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.status_code == 200
+    assert resp.headers['Last-Modified'] == 'Thu, 02 Jan 2020 00:00:00 GMT'
+    data['last_modified'] = '2020-01-02T10:00:00+02:00'
+    recipes['default'] = Recipe(data)
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.headers['Last-Modified'] == 'Thu, 02 Jan 2020 08:00:00 GMT'
+
+
+def test_version_answers_not_modified_without_rendering(client, fetchall,
+                                                        layer):
+    layer.recipe['version'] = 42
+    calls = []
+    fetchall([], lambda *args, **kwargs: calls.append(1))
+    etag = client.get('/all/0/0/0.pbf').headers['ETag']
+    assert len(calls) == 1
+    resp = client.get('/all/0/0/0.pbf', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert len(calls) == 1
+    layer.recipe['version'] = 43
+    resp = client.get('/all/0/0/0.pbf', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert len(calls) == 2
+
+
+def test_max_age_by_zoom(client, fetchall, layer):
+    layer.recipe['max_age'] = {0: 86400, 10: 3600}
+    fetchall([])
+    resp = client.get('/all/0/0/0.pbf')
+    assert resp.headers['Cache-Control'] == 'public, max-age=86400'
+    resp = client.get('/all/12/0/0.pbf')
+    assert resp.headers['Cache-Control'] == 'public, max-age=3600'
+
+
+def test_tiles_are_compressed_when_accepted(client, fetchall):
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}])
+    raw = client.get('/all/0/0/0.pbf')
+    assert 'Content-Encoding' not in raw.headers
+    assert raw.headers['Vary'] == 'Accept-Encoding'
+    resp = client.get('/all/0/0/0.pbf',
+                      headers={'Accept-Encoding': 'gzip, deflate'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(resp.data) == raw.data
+    assert resp.headers['ETag'] != raw.headers['ETag']
+
+
+def test_compression_can_be_disabled_per_format(client, fetchall, config):
+    config.COMPRESSION = {'pbf': {}, 'json': {'gzip': 1}}
+    fetchall([])
+    resp = client.get('/all/0/0/0.pbf', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Vary' not in resp.headers
+    resp = client.get('/all/0/0/0.json', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+
+
+def test_compressed_tiles_are_cached(client, fetchall, cache):
+    calls = []
+    fetchall([], lambda *args, **kwargs: calls.append(1))
+    headers = {'Accept-Encoding': 'gzip'}
+    first = client.get('/mylayer/0/0/0.pbf', headers=headers)
+    second = client.get('/mylayer/0/0/0.pbf', headers=headers)
+    assert second.data == first.data
+    assert len(calls) == 1
+    assert cache.get(('default', 'mylayer', 0, 0, 0, 'pbf.gz')) == first.data
+
+
+def test_concurrent_requests_render_once(client, monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def fetchall(*args, **kwargs):
+        calls.append(1)
+        release.wait(1)
+        return [{'_way': 'POINT(0 0)', 'name': 'foo'}]
+
+    monkeypatch.setattr('utilery.core.DB.fetchall', fetchall)
+    responses = []
+
+    def get():
+        responses.append(client.get('/all/0/0/0.pbf'))
+
+    threads = [threading.Thread(target=get) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(1)
+    assert len(calls) == 1
+    assert len({resp.data for resp in responses}) == 1
+
+
+def test_stale_tiles_are_served_while_revalidated(client, fetchall,
+                                                  monkeypatch):
+    from utilery.cache import Cache, MemoryCache
+    monkeypatch.setattr(Cache, 'backend', MemoryCache(ttl=10, stale=60))
+    fetchall([])
+    first = client.get('/all/0/0/0.pbf')
+    now = time.time()
+    monkeypatch.setattr('time.time', lambda: now + 11)
+    done = threading.Event()
+    fetchall([{'_way': 'POINT(0 0)', 'name': 'foo'}],
+             lambda *args, **kwargs: done.set())
+    stale = client.get('/all/0/0/0.pbf')
+    assert stale.data == first.data
+    assert done.wait(1)
+    for i in range(20):
+        fresh = client.get('/all/0/0/0.pbf')
+        if fresh.data != first.data:
+            break
+        time.sleep(0.01)
+    assert mapbox_vector_tile.decode(fresh.data)['mylayer']['features']
+
+
+def test_metatile_renders_siblings_with_one_query(client, fetchall, layer,
+                                                  cache):
+    layer.recipe['metatile'] = 2
+    calls = []
+
+    def check(query, args, **kwargs):
+        calls.append(args)
+
+    # Block grid is 2 * 4096 units wide, y axis going north.
+    point = shapely.geometry.Point(1000, 5000)
+    fetchall([{'_way': memoryview(point.wkb), 'name': 'foo'}], check)
+    resp = client.get('/all/1/0/0.pbf')
+    assert len(calls) == 1
+    assert calls[0]['extent'] == 8192
+    assert calls[0]['west'] == -calls[0]['east']
+    tile = mapbox_vector_tile.decode(resp.data)
+    feature = tile['mylayer']['features'][0]
+    assert feature['geometry']['coordinates'] == [1000, 904]
+    resp = client.get('/all/1/1/1.pbf')
+    assert len(calls) == 1
+    tile = mapbox_vector_tile.decode(resp.data)
+    assert tile['mylayer']['features'] == []
+
+
+def test_metatile_clips_per_tile(client, fetchall, layer):
+    layer.recipe['metatile'] = 2
+    layer['buffer'] = 4
+    layer.queries[0]['clip'] = True
+    line = shapely.geometry.LineString([(1000, 1000), (7000, 1000)])
+    fetchall([{'_way': line.wkb, 'name': 'foo'}])
+    tile = mapbox_vector_tile.decode(client.get('/all/1/1/1.pbf').data)
+    feature = tile['mylayer']['features'][0]
+    assert feature['geometry']['coordinates'] == [[-64, 1000], [2904, 1000]]
+    tile = mapbox_vector_tile.decode(client.get('/all/1/0/1.pbf').data)
+    feature = tile['mylayer']['features'][0]
+    assert feature['geometry']['coordinates'] == [[1000, 1000], [4160, 1000]]
+
+
+def test_tuple_rows_use_cursor_columns(client, fetchall):
+    fetchall(Rows([('{"type": "Point", "coordinates": [0, 0]}', 'foo', 1)],
+                  ['_way', 'name', '_rank']))
+
+    resp = client.get('/all/0/0/0.geojson')
+    assert json.loads(resp.data.decode())['features'] == [{
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [0, 0]},
+        'properties': {'name': 'foo', 'layer': 'mylayer'},
+    }]
+    resp = client.get('/all/0/0/0.json')
+    assert json.loads(resp.data.decode())[0]['features'] == [{
+        'geometry': {'type': 'Point', 'coordinates': [0, 0]},
+        'properties': {'name': 'foo'},
+    }]
+
+
+def test_json_geometries_are_spliced_as_is(client, fetchall, monkeypatch):
+    # Never parsed: a geometry the json module would reject goes through.
+    monkeypatch.setattr('utilery.views.json.loads', None)
+    fetchall([{'_way': '{"type":"Point","coordinates":[1e400,0]}',
+               'name': 'foo'}])
+    resp = client.get('/all/0/0/0.geojson')
+    assert b'"coordinates":[1e400,0]' in resp.data
+
+
+def test_json_without_orjson(client, fetchall, monkeypatch):
+    monkeypatch.setattr('utilery.views.orjson', None)
+    fetchall([{'_way': '{"type": "Point", "coordinates": [0, 0]}',
+               'name': 'foo'}] * 2)
+    resp = client.get('/all/0/0/0.json')
+    assert json.loads(resp.data.decode()) == [{
+        'name': 'mylayer',
+        'features': [{
+            'geometry': {'type': 'Point', 'coordinates': [0, 0]},
+            'properties': {'name': 'foo'},
+        }] * 2,
+    }]
+
+
+def test_streamed_responses(client, fetchall, config, cache, monkeypatch):
+    config.STREAM_RESPONSES = True
+    monkeypatch.setattr('utilery.views.ServeJSON.CHUNK_SIZE', 100)
+    fetchall([{'_way': '{"type": "Point", "coordinates": [0, 0]}',
+               'name': 'foo'}] * 10)
+    resp = client.get('/all/0/0/0.geojson', buffered=False)
+    assert resp.is_streamed
+    assert 'ETag' not in resp.headers
+    chunks = list(resp.response)
+    assert len(chunks) > 1
+    data = json.loads(b''.join(chunks).decode())
+    assert len(data['features']) == 10
+    # Once sent, the tile is cached, and served with an ETag.
+    assert cache.get(('default', 'all', 0, 0, 0, 'geojson')) == \
+        b''.join(chunks)
+    resp = client.get('/all/0/0/0.geojson')
+    assert 'ETag' in resp.headers
+    assert json.loads(resp.data.decode()) == data
+
+
+def test_streamed_responses_are_compressed(client, fetchall, config):
+    config.STREAM_RESPONSES = True
+    fetchall([{'_way': '{"type": "Point", "coordinates": [0, 0]}',
+               'name': 'foo'}] * 10)
+    resp = client.get('/all/0/0/0.json', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    data = json.loads(gzip.decompress(resp.data).decode())
+    assert len(data[0]['features']) == 10
+
+
+def test_streamed_responses_check_layers_first(client, fetchall, config):
+    config.STREAM_RESPONSES = True
+    fetchall([])
+    resp = client.get('/unknown/0/0/0.json')
+    assert resp.status_code == 400
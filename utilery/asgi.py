@@ -0,0 +1,256 @@
+"""ASGI entry point.
+
+Run it with any ASGI server, eg.: uvicorn utilery.asgi:app
+
+Tile queries are run with asyncpg, so many of them can be in flight at once
+from a single process, while the CPU bound encoding is run in an executor.
+"""
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import Future
+from functools import partial
+
+import asyncpg
+import psycopg2.extensions
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.wrappers import Request
+
+from . import metrics
+from .core import DB, init
+from .plugins import Plugins
+from .views import ServeTile, View, WithEndPoint, make_response, url_map
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDB(object):
+
+    _ = {}
+
+    @classmethod
+    async def pool(cls, dbname=None):
+        dbname = dbname or DB.DEFAULT
+        if dbname not in cls._:
+            # Store the task, so concurrent requests wait for the same pool.
+            cls._[dbname] = asyncio.ensure_future(cls.create_pool(dbname))
+        return await cls._[dbname]
+
+    @classmethod
+    async def create_pool(cls, dbname):
+        options = DB.options(dbname)
+        return await asyncpg.create_pool(min_size=options['minconn'],
+                                         max_size=options['maxconn'],
+                                         **cls.parse_dsn(options['dsn']))
+
+    # libpq keywords asyncpg knows under another name.
+    DSN_KEYS = {'dbname': 'database', 'sslmode': 'ssl',
+                'connect_timeout': 'timeout'}
+    DSN_ACCEPTED = {'host', 'port', 'user', 'password', 'passfile',
+                    'database', 'ssl', 'timeout'}
+
+    @classmethod
+    def parse_dsn(cls, dsn):
+        """asyncpg connection parameters of a libpq connection string, as
+        "key=value" pairs or as an URI."""
+        params = {}
+        for key, value in psycopg2.extensions.parse_dsn(dsn).items():
+            if key == 'application_name':
+                params['server_settings'] = {key: value}
+                continue
+            key = cls.DSN_KEYS.get(key, key)
+            if key not in cls.DSN_ACCEPTED:
+                logger.warning('Ignoring connection parameter "%s", not '
+                               'supported by asyncpg', key)
+                continue
+            params[key] = value
+        if params.get('port', '').isdigit():
+            params['port'] = int(params['port'])
+        if 'timeout' in params:
+            params['timeout'] = float(params['timeout'])
+        return params
+
+    @classmethod
+    async def fetchall(cls, statement, args, dbname=None):
+        """Run a Statement, asyncpg taking care of preparing it."""
+        pool = await cls.pool(dbname)
+        timeout = DB.options(dbname or DB.DEFAULT)['timeout']
+        async with pool.acquire(timeout=timeout) as conn:
+            return await conn.fetch(statement.prepared,
+                                    *[args[name] for name in statement.params])
+
+    @classmethod
+    async def close(cls):
+        for pool in cls._.values():
+            await (await pool).close()
+        cls._.clear()
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def fetch(view, query):
+    before = time.perf_counter()
+    sql = view.sql(query)
+    rows = await AsyncDB.fetchall(sql, view.params, query.dbname)
+    duration = time.perf_counter() - before
+    view.timings.add('db', query.layer['name'], duration)
+    view.profile(sql, query.dbname, duration, query.layer['name'])
+    return rows
+
+
+async def prefetch(view, layers):
+    """Fetch all the rows of the tile, as the thread pool would do."""
+    queries = list(view.prefetchable(layers))
+    try:
+        results = await asyncio.gather(*(fetch(view, query)
+                                         for query in queries))
+    except asyncio.TimeoutError:
+        abort(503, 'No connection available')
+    except asyncpg.PostgresError as e:
+        abort(500, str(e))
+    for query, rows in zip(queries, results):
+        future = Future()
+        future.set_result(rows)
+        view.pending[id(query)] = future
+
+
+async def render(view):
+    layers = view.load_layers()
+    await prefetch(view, layers)
+    # Queries not prefetched (streamed ones, postgis engine) fallback to the
+    # sync pool.
+    content = await run(view.render_layers, layers)
+    content = await run(view.compress, content)
+    await run(view.store, content)
+    return content
+
+
+async def serve(endpoint, request, **kwargs):
+    Class = WithEndPoint.endpoints.get(endpoint)
+    if not Class or not issubclass(Class, ServeTile) \
+       or request.method != 'GET':
+        return await run(View.serve, endpoint, request, **kwargs)
+    view = Class(request)
+    view.setup(**kwargs)
+    before = time.perf_counter()
+    labels = view.labels
+    try:
+        view.check_names()
+        etag = view.version_etag()
+        if etag and etag in request.if_none_match:
+            return view.response(b'', etag)
+        content = await run(view.lookup)
+        if content is None:
+            metrics.CACHE_MISSES.inc(**labels)
+            content = await flight(view)
+        else:
+            metrics.CACHE_HITS.inc(**labels)
+    except Exception as e:
+        metrics.ERRORS.inc(status=getattr(e, 'code', 500), **labels)
+        raise
+    metrics.TILE_SECONDS.observe(time.perf_counter() - before,
+                                 zoom=view.zoom, **labels)
+    metrics.TILE_BYTES.observe(len(content), zoom=view.zoom, **labels)
+    return view.response(content, etag)
+
+
+async def flight(view):
+    if view.metatile > 1:
+        # Metatiles are fetched and split by the sync pipeline.
+        return await run(view.flight)
+    future, leader = view.flights.join(view.key)
+    if not leader:
+        return await asyncio.wrap_future(future)
+    try:
+        content = await render(view)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(content)
+    finally:
+        view.flights.leave(view.key)
+    return content
+
+
+def to_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            init()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await AsyncDB.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    init()
+    environ = to_environ(scope, await read_body(receive))
+    urls = url_map.bind_to_environ(environ)
+    try:
+        endpoint, kwargs = urls.match()
+        request = Request(environ)
+        response = Plugins.hook('request', endpoint=endpoint, request=request,
+                                **kwargs)
+        if not response:
+            response = await serve(endpoint, request, **kwargs)
+        response = make_response(response)
+    except HTTPException as e:
+        response = e.get_response(environ)
+    else:
+        response = Plugins.hook('response', response=response, request=request) or response  # noqa
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in response.get_wsgi_headers(environ).items()],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b''.join(response.iter_encoded()),
+    })
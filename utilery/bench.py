@@ -0,0 +1,260 @@
+"Benchmark the tile rendering pipeline, against a stand-in database."
+
+import hashlib
+import itertools
+import json
+import logging
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import shapely.geometry
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from .cache import Cache
+from .expire import read_expire_list
+from .models import Columns
+from .seed import tiles as bbox_tiles
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['pbf', 'json', 'geojson']
+
+
+def synthetic_rows(query, count, seed=0):
+    """Rows as the database would send them for `query`: WKB in the tile
+    grid for protobuf tiles, GeoJSON otherwise."""
+    rand = random.Random(seed)
+    rows = []
+    for i in range(count):
+        if i % 2:
+            coords = [(rand.uniform(0, 4096), rand.uniform(0, 4096))
+                      for _ in range(10)]
+            geometry = shapely.geometry.LineString(coords)
+        else:
+            geometry = shapely.geometry.Point(rand.uniform(0, 4096),
+                                              rand.uniform(0, 4096))
+        if 'ST_AsGeoJSON' in query:
+            way = json.dumps(shapely.geometry.mapping(geometry))
+        else:
+            way = geometry.wkb
+        rows.append({'_way': way, 'id': i, 'name': 'feature {}'.format(i),
+                     'type': rand.choice(['residential', 'forest', 'park'])})
+    return rows
+
+
+class StandInDB(object):
+    """Answer the queries of DB.fetchall and DB.iterate with recorded rows.
+
+    Rows are keyed by query and parameters; unknown queries get `features`
+    synthetic rows, or none."""
+
+    def __init__(self, fixtures=None, features=0):
+        self.fixtures = fixtures or {}
+        self.features = features
+
+    @staticmethod
+    def key(query, args):
+        args = json.dumps(args or {}, sort_keys=True, default=str)
+        return hashlib.md5((str(query) + args).encode()).hexdigest()
+
+    def fetchall(self, query, args=None, dbname=None, **kwargs):
+        key = self.key(query, args)
+        if key not in self.fixtures and self.features:
+            self.fixtures[key] = synthetic_rows(str(query), self.features)
+        return self.fixtures.get(key, [])
+
+    def iterate(self, query, args=None, dbname=None, batch_size=None):
+        yield from self.fetchall(query, args, dbname)
+
+    def recorder(self, fetchall):
+        """Wrap the real `fetchall`, keeping what it returns."""
+        def record(query, args=None, dbname=None, **kwargs):
+            rows = fetchall(query, args, dbname=dbname, **kwargs)
+            columns = getattr(rows, 'columns', None)
+            self.fixtures[self.key(query, args)] = [
+                dict(zip(columns, r)) if columns is not None else dict(r)
+                for r in rows]
+            return rows
+        return record
+
+    @contextmanager
+    def install(self, record=False):
+        from .core import DB
+        # Keep the classmethods themselves, not the bound methods.
+        saved = DB.__dict__['fetchall'], DB.__dict__['iterate']
+        if record:
+            DB.fetchall = self.recorder(DB.fetchall)
+            DB.iterate = lambda query, args=None, dbname=None, **kw: \
+                iter(DB.fetchall(query, args, dbname))
+        else:
+            DB.fetchall, DB.iterate = self.fetchall, self.iterate
+        try:
+            yield self
+        finally:
+            DB.fetchall, DB.iterate = saved
+
+    def save(self, path):
+        def default(value):
+            if isinstance(value, (bytes, memoryview)):
+                return {'$bytes': bytes(value).hex()}
+            return str(value)
+        with open(path, 'w') as f:
+            json.dump(self.fixtures, f, default=default)
+
+    @classmethod
+    def load(cls, path, features=0):
+        def hook(value):
+            if list(value) == ['$bytes']:
+                return bytes.fromhex(value['$bytes'])
+            return value
+        with open(path) as f:
+            return cls(json.load(f, object_hook=hook), features=features)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted `values`."""
+    index = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[index]
+
+
+def request_tiles(client, tiles, format, names, recipe):
+    """Request each tile of `tiles`, and return the latency of each one."""
+    latencies = []
+    for tile in tiles:
+        url = '/{}/{}/{}/{}/{}.{}'.format(recipe, names, tile.z, tile.x,
+                                          tile.y, format)
+        started = time.perf_counter()
+        resp = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        if resp.status_code != 200:
+            raise ValueError('{} returned {}'.format(url, resp.status_code))
+    return latencies
+
+
+def bench_app(tiles, formats=FORMATS, names='all', recipe='default'):
+    """Request each tile of `tiles` in each format, through the WSGI app.
+
+    The tiles cache is disabled meanwhile, so each request renders. Tracing
+    allocations slows everything down: the peak memory is measured in a
+    second pass, apart from the timings."""
+    from .views import app
+    client = Client(app, BaseResponse)
+    backend, Cache.backend = Cache.backend, None
+    results = {}
+    try:
+        for format in formats:
+            before = time.perf_counter()
+            latencies = request_tiles(client, tiles, format, names, recipe)
+            elapsed = time.perf_counter() - before
+            tracemalloc.start()
+            try:
+                request_tiles(client, tiles, format, names, recipe)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            latencies.sort()
+            results[format] = {
+                'tiles': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'tiles_per_second': len(latencies) / elapsed,
+                'peak_memory': peak,
+            }
+    finally:
+        Cache.backend = backend
+    return results
+
+
+def bench_encoding(sizes=(100, 1000, 10000), recipe='default'):
+    """Time the conversion of rows to features and the protobuf encoding
+    of growing synthetic layers."""
+    from .core import RECIPES
+    from .views import ServePBF
+    layer = next(iter(RECIPES[recipe].layers.values()))
+    view = ServePBF(None)
+    results = {}
+    for size in sizes:
+        rows = synthetic_rows('', size)
+        columns = Columns(rows[0].keys())
+        rows = [columns.to_tuple(row) for row in rows]
+        before = time.perf_counter()
+        features = [view.to_feature(row, columns, layer) for row in rows]
+        converted = time.perf_counter()
+        layer.encoder.encode(features)
+        encoded = time.perf_counter()
+        results[size] = {
+            'convert': converted - before,
+            'encode': encoded - converted,
+            'features_per_second': size / (encoded - before),
+        }
+    return results
+
+
+def get_tiles(args):
+    if args.tiles:
+        with open(args.tiles) as f:
+            return list(read_expire_list(f))
+    found = bbox_tiles(args.bbox, args.minzoom, args.maxzoom)
+    return list(itertools.islice(found, args.limit))
+
+
+def add_arguments(parser):
+    parser.add_argument('--recipe', default='default',
+                        help='Name of the recipe to benchmark')
+    parser.add_argument('--names', default='all',
+                        help='"+" separated layers names, or "all"')
+    parser.add_argument('--tiles', help='File of "z/x/y" tiles to request')
+    parser.add_argument('--bbox', nargs=4, type=float,
+                        default=[-180, -85.0511, 180, 85.0511],
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='Bounding box of the requested tiles, when no '
+                             '--tiles is given')
+    parser.add_argument('--minzoom', type=int, default=0)
+    parser.add_argument('--maxzoom', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=200,
+                        help='Maximum number of tiles from --bbox')
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='Comma separated formats to benchmark')
+    parser.add_argument('--fixtures',
+                        help='Recorded rows to replay (see --record)')
+    parser.add_argument('--record', action='store_true',
+                        help='Query the real database, saving the rows '
+                             'into --fixtures')
+    parser.add_argument('--features', type=int, default=100,
+                        help='Synthetic rows per query not in the fixtures')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='Comma separated layer sizes for the encoding '
+                             'benchmark')
+
+
+def main(args):
+    from .core import RECIPES
+    if args.recipe not in RECIPES:
+        raise ValueError('Unknown recipe "{}"'.format(args.recipe))
+    if args.record and not args.fixtures:
+        raise ValueError('--record needs --fixtures')
+    if args.fixtures and not args.record:
+        db = StandInDB.load(args.fixtures, features=args.features)
+    else:
+        db = StandInDB(features=args.features)
+    tiles = get_tiles(args)
+    with db.install(record=args.record):
+        results = bench_app(tiles, args.formats.split(','), args.names,
+                            args.recipe)
+    if args.record:
+        db.save(args.fixtures)
+    for format, stats in results.items():
+        logger.info('%-8s %d tiles, %.1f tiles/s, p50 %.1fms, p95 %.1fms, '
+                    'p99 %.1fms, peak memory %.1fMB', format, stats['tiles'],
+                    stats['tiles_per_second'], stats['p50'] * 1000,
+                    stats['p95'] * 1000, stats['p99'] * 1000,
+                    stats['peak_memory'] / 2 ** 20)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    for size, stats in bench_encoding(sizes, args.recipe).items():
+        logger.info('encoding %d features: convert %.1fms, encode %.1fms, '
+                    '%.0f features/s', size, stats['convert'] * 1000,
+                    stats['encode'] * 1000, stats['features_per_second'])
@@ -0,0 +1,138 @@
+"""Make protobuf tiles fit in a maximum size and number of features.
+
+When over budget, the layers lose, step by step: their low priority
+properties, some geometry details, then their low priority features."""
+
+import logging
+from functools import partial
+
+import shapely.wkb
+import shapely.wkt
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def geometry(feature):
+    value = feature['geometry']
+    if isinstance(value, str):
+        return shapely.wkt.loads(value)
+    if isinstance(value, (bytes, memoryview)):
+        return shapely.wkb.loads(bytes(value))
+    return value
+
+
+def priority(feature, key):
+    """Value of `key` for `feature`, None when it is not set."""
+    if key in ('area', 'length'):
+        return getattr(geometry(feature), key)
+    return feature['properties'].get(key.lstrip('-'))
+
+
+def ranked(features, key):
+    """Indices of `features`, the sooner dropped first: the ones without
+    `key`, then by increasing value (decreasing with a `-` prefix)."""
+    values = [priority(feature, key) for feature in features]
+    missing = [i for i, value in enumerate(values) if value is None]
+    found = sorted((i for i, value in enumerate(values) if value is not None),
+                   key=values.__getitem__, reverse=key.startswith('-'))
+    return missing + found
+
+
+class Budget(object):
+
+    # Simplification tolerances tried, in tile units (16 per pixel).
+    TOLERANCES = [8, 16, 32, 64]
+    # Keep a bit less features than the size ratio, to converge faster.
+    MARGIN = .9
+
+    def __init__(self, recipe, zoom, max_size=None, max_features=None):
+        self.recipe = recipe
+        self.zoom = zoom
+        self.max_size = max_size
+        self.max_features = max_features
+
+    def fit(self, layers):
+        """Encode `layers`, a list of (Layer, {name, features}) pairs, and
+        return the encoded layers."""
+        total = sum(len(data['features']) for layer, data in layers)
+        if self.max_features and total > self.max_features:
+            self.drop(layers, self.max_features / total)
+        encoded = [self.encode(layer, data) for layer, data in layers]
+        if not self.max_size:
+            return encoded
+        actions = [self.strip] + [partial(self.coarsen, tolerance=tolerance)
+                                  for tolerance in self.TOLERANCES]
+        for action in actions:
+            if self.size(encoded) <= self.max_size:
+                return encoded
+            for i, (layer, data) in enumerate(layers):
+                if action(layer, data):
+                    encoded[i] = self.encode(layer, data)
+        while self.size(encoded) > self.max_size:
+            ratio = self.max_size / self.size(encoded) * self.MARGIN
+            if not self.drop(layers, ratio):
+                logger.warning('Tile %s/%s still over budget (%s bytes)',
+                               self.recipe.name, self.zoom,
+                               self.size(encoded))
+                break
+            encoded = [self.encode(layer, data) for layer, data in layers]
+        return encoded
+
+    @staticmethod
+    def encode(layer, data):
+        return layer.encoder.encode(data['features'])
+
+    @staticmethod
+    def size(encoded):
+        return sum(len(layer) for layer in encoded)
+
+    def count(self, layer, action, value):
+        if value:
+            metrics.BUDGET_DROPPED.inc(value, recipe=self.recipe.name,
+                                       layer=layer['name'], action=action)
+
+    def strip(self, layer, data):
+        names = set(layer.strip_properties or [])
+        if not names:
+            return False
+        stripped = 0
+        for feature in data['features']:
+            if names & set(feature['properties']):
+                feature['properties'] = {k: v for k, v in
+                                         feature['properties'].items()
+                                         if k not in names}
+                stripped += 1
+        self.count(layer, 'properties', stripped)
+        return bool(stripped)
+
+    def coarsen(self, layer, data, tolerance):
+        coarsened = 0
+        for feature in data['features']:
+            geom = geometry(feature)
+            if geom.geom_type in ('Point', 'MultiPoint'):
+                continue
+            feature['geometry'] = geom.simplify(tolerance)
+            coarsened += 1
+        self.count(layer, 'coarsened', coarsened)
+        return bool(coarsened)
+
+    def drop(self, layers, ratio):
+        """Keep only `ratio` of the features of each layer, by priority."""
+        dropped = 0
+        for layer, data in layers:
+            features = data['features']
+            keep = int(len(features) * ratio)
+            if keep == len(features):
+                continue
+            if layer.drop_priority:
+                order = ranked(features, layer.drop_priority)
+                kept = sorted(order[len(order) - keep:])
+                data['features'] = [features[i] for i in kept]
+            else:
+                # Without priority, the last rows go first.
+                data['features'] = features[:keep]
+            self.count(layer, 'features', len(features) - keep)
+            dropped += len(features) - keep
+        return dropped
@@ -0,0 +1,290 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from pathlib import Path
+
+from . import config
+from .utils import by_zoom, import_by_path
+
+
+TileKey = namedtuple('TileKey', ['recipe', 'names', 'z', 'x', 'y', 'format'])
+
+
+class BaseCache(object):
+    """Base class for rendered tiles caches.
+
+    `ttl` is either a number of seconds, or a dict of {zoom: seconds}, where
+    each value applies from its zoom up to the next defined one. A `None`
+    ttl means no expiration, a ttl of 0 means no caching. Expired tiles are
+    still returned by `get_stale` for `stale` more seconds, by the backends
+    supporting it.
+
+    `shared` tells whether the tiles stored by a process are seen by the
+    others, so they can be expired from outside the server."""
+
+    shared = True
+
+    def __init__(self, ttl=None, stale=0):
+        self.ttl = ttl
+        self.stale = stale
+
+    def timeout(self, z):
+        return by_zoom(self.ttl, z)
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_stale(self, key):
+        """Return the tile and whether it has expired."""
+        return self.get(key), False
+
+    def exists(self, key):
+        """Whether a fresh tile is stored, without fetching it."""
+        return self.get(key) is not None
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def purge(self, recipe, z, x, y):
+        """Remove every cached version (layers, formats) of a tile."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(BaseCache):
+    """Bounded in-process LRU cache."""
+
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=None, stale=0):
+        super().__init__(ttl, stale)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value, stale = self.get_stale(key)
+        return None if stale else value
+
+    def get_stale(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return None, False
+            now = time.time()
+            if expires is not None and expires + self.stale < now:
+                del self._data[key]
+                return None, False
+            self._data.move_to_end(key)
+            return value, expires is not None and expires < now
+
+    def set(self, key, value):
+        timeout = self.timeout(key.z)
+        if timeout == 0:
+            return
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def purge(self, recipe, z, x, y):
+        with self._lock:
+            for key in list(self._data):
+                if (key.recipe, key.z, key.x, key.y) == (recipe, z, x, y):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileCache(BaseCache):
+    """Store tiles on disk, as root/recipe/z/x/y/names.format."""
+
+    def __init__(self, root, ttl=None, stale=0):
+        super().__init__(ttl, stale)
+        self.root = Path(root)
+
+    def tile_dir(self, recipe, z, x, y):
+        return self.root / recipe / str(z) / str(x) / str(y)
+
+    def path(self, key):
+        return (self.tile_dir(key.recipe, key.z, key.x, key.y)
+                / '{}.{}'.format(key.names, key.format))
+
+    def get(self, key):
+        value, stale = self.get_stale(key)
+        return None if stale else value
+
+    def get_stale(self, key):
+        path = self.path(key)
+        try:
+            age = time.time() - path.stat().st_mtime
+            timeout = self.timeout(key.z)
+            if timeout is not None and age > timeout + self.stale:
+                return None, False
+            with path.open('rb') as f:
+                return f.read(), timeout is not None and age > timeout
+        except (FileNotFoundError, NotADirectoryError):
+            return None, False
+
+    def exists(self, key):
+        try:
+            age = time.time() - self.path(key).stat().st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        timeout = self.timeout(key.z)
+        return timeout is None or age <= timeout
+
+    def set(self, key, value):
+        if self.timeout(key.z) == 0:
+            return
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write in a temporary file first, so readers never get a partial
+        # tile.
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(tmp, str(path))
+
+    def purge(self, recipe, z, x, y):
+        shutil.rmtree(str(self.tile_dir(recipe, z, x, y)), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(str(self.root), ignore_errors=True)
+
+
+class RedisCache(BaseCache):
+    """Store tiles in any server speaking the Redis protocol.
+
+    All versions of a tile are stored in one hash, so they can be purged
+    at once."""
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='utilery',
+                 ttl=None, client=None):
+        super().__init__(ttl)
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def hash_key(self, recipe, z, x, y):
+        return '{}:{}:{}:{}:{}'.format(self.prefix, recipe, z, x, y)
+
+    def field(self, key):
+        return '{}.{}'.format(key.names, key.format)
+
+    def get(self, key):
+        hash_key = self.hash_key(key.recipe, key.z, key.x, key.y)
+        return self.client.hget(hash_key, self.field(key))
+
+    def exists(self, key):
+        hash_key = self.hash_key(key.recipe, key.z, key.x, key.y)
+        return bool(self.client.hexists(hash_key, self.field(key)))
+
+    def set(self, key, value):
+        timeout = self.timeout(key.z)
+        if timeout == 0:
+            return
+        hash_key = self.hash_key(key.recipe, key.z, key.x, key.y)
+        pipe = self.client.pipeline()
+        pipe.hset(hash_key, self.field(key), value)
+        if timeout is not None:
+            pipe.expire(hash_key, timeout)
+        pipe.execute()
+
+    def purge(self, recipe, z, x, y):
+        self.client.delete(self.hash_key(recipe, z, x, y))
+
+    def clear(self):
+        keys = list(self.client.scan_iter('{}:*'.format(self.prefix)))
+        if keys:
+            self.client.delete(*keys)
+
+
+class SingleFlight(object):
+    """Share the result of a computation between concurrent callers asking
+    for the same key, instead of running it once per caller."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return the Future of the call in flight for `key`, and whether
+        the caller is the one in charge of running it."""
+        with self._lock:
+            if key in self._calls:
+                return self._calls[key], False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def leave(self, key):
+        with self._lock:
+            del self._calls[key]
+
+    def run(self, key, future, func):
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self.leave(key)
+
+    def do(self, key, func):
+        future, leader = self.join(key)
+        if leader:
+            self.run(key, future, func)
+        return future.result()
+
+    def spawn(self, key, func):
+        """Run `func` in a background thread, unless already in flight."""
+        future, leader = self.join(key)
+        if leader:
+            threading.Thread(target=self.run, args=(key, future, func),
+                             daemon=True).start()
+        return future
+
+
+class Cache(object):
+
+    backend = None
+
+    @classmethod
+    def load(cls):
+        if config.CACHE:
+            options = dict(config.CACHE)
+            Backend = import_by_path(options.pop('backend'))
+            cls.backend = Backend(**options)
+
+    @classmethod
+    def get(cls, key):
+        if cls.backend is not None:
+            return cls.backend.get(key)
+
+    @classmethod
+    def get_stale(cls, key):
+        if cls.backend is not None:
+            return cls.backend.get_stale(key)
+        return None, False
+
+    @classmethod
+    def set(cls, key, value):
+        if cls.backend is not None:
+            cls.backend.set(key, value)
+
+    @classmethod
+    def purge(cls, recipe, z, x, y):
+        if cls.backend is not None:
+            cls.backend.purge(recipe, z, x, y)
@@ -0,0 +1,38 @@
+import argparse
+import logging
+import sys
+
+from . import bench, expire, seed, serve
+from .core import init
+
+COMMANDS = {
+    'bench': bench,
+    'expire': expire,
+    'seed': seed,
+    'serve': serve,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='utilery')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    for name, module in sorted(COMMANDS.items()):
+        subparser = subparsers.add_parser(name, help=module.__doc__)
+        module.add_arguments(subparser)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(message)s')
+    try:
+        init()
+        COMMANDS[args.command].main(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
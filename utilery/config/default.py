@@ -1,7 +1,27 @@
 DATABASES = {
     "default": "dbname=osm user=osm password=osm host=localhost"
 }
+DB_POOL = {
+    "minconn": 1,
+    "maxconn": 10,
+    "timeout": 5,
+    "check_interval": 30,
+}
+PARALLEL_QUERIES = 0
+PREPARED_STATEMENTS = True
+STREAM_BATCH_SIZE = 1000
+STREAM_RESPONSES = False
+SLOW_QUERIES = None
+CACHE = None
+MBTILES = {}
+METRICS = True
+COMPRESSION = {
+    'pbf': {'gzip': 6, 'br': 5},
+    'json': {'gzip': 6, 'br': 5},
+    'geojson': {'gzip': 6, 'br': 5},
+}
 RECIPES = []
+RECIPES_CACHE = None
 TILEJSON = {
     "tilejson": "2.1.0",
     "name": "utilery",
@@ -19,4 +39,17 @@ SRID = 900913
 SCALE = 1
 BUFFER = 0
 CLIP = False
+ENGINE = 'python'
+STREAM = False
+MAX_FEATURES = None
+MAX_BYTES = None
+MAX_TILE_SIZE = None
+MAX_TILE_FEATURES = None
+DROP_PRIORITY = None
+STRIP_PROPERTIES = None
+MAX_AGE = None
+METATILE = 1
+SIMPLIFY = False
+SNAP_TO_GRID = False
+MIN_AREA_PIXELS = None
 CORS = "*"
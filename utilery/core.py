@@ -1,15 +1,26 @@
 import atexit
+import hashlib
+import itertools
 import logging
+import os
+import pickle
+import re
+import threading
 import time
+from contextlib import contextmanager
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import yaml
 from pathlib import Path
 
 from . import config
+from .cache import Cache
 from .plugins import Plugins
 from .models import Recipe
+from .utils import on_fork
 
 logger = logging.getLogger(__name__)
 
@@ -20,44 +31,298 @@ if config.DEBUG:
 
 
 RECIPES = {}
+INITIALIZED = False
+_init_lock = threading.Lock()
+
+# The C loader is much faster, but needs PyYAML built against libyaml.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+class Connection(psycopg2.extensions.connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names of the statements prepared on this connection.
+        self.prepared = set()
+
+
+class Statement(str):
+    """SQL with !west!, !south!, !east!, !north!, !zoom!, !pixel_width! and
+    !extent! placeholders.
+
+    The string value is the psycopg2 form (%(name)s), and `prepared` holds
+    the form with positional parameters, to be used with PREPARE."""
+
+    PARAMS = {
+        'west': 'float8',
+        'south': 'float8',
+        'east': 'float8',
+        'north': 'float8',
+        'zoom': 'integer',
+        'pixel_width': 'float8',
+        'extent': 'float8',
+    }
+    PLACEHOLDER = re.compile('!({})!'.format('|'.join(PARAMS)))
+
+    def __new__(cls, sql):
+        self = super().__new__(cls, cls.PLACEHOLDER.sub(
+            r'%(\1)s', sql.replace('%', '%%')))
+        self.params = []
+
+        def positional(match):
+            name = match.group(1)
+            if name not in self.params:
+                self.params.append(name)
+            return '${}::{}'.format(self.params.index(name) + 1,
+                                    cls.PARAMS[name])
+
+        self.prepared = cls.PLACEHOLDER.sub(positional, sql)
+        self.name = 'utilery_' + hashlib.md5(sql.encode()).hexdigest()[:16]
+        return self
+
+
+class Pool(object):
+    """Thread safe pool of connections to one database.
+
+    Connections are health checked when taken out of the pool, and broken
+    ones are replaced transparently. The lock only guards the bookkeeping:
+    no round trip to the server is made while holding it."""
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5,
+                 check_interval=30):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.closed = False
+        self._idle = []  # (connection, last used timestamp) pairs.
+        self._size = 0  # Idle and checked out connections.
+        self._lock = threading.Condition()
+        for i in range(minconn):
+            self._idle.append((self._connect(), time.time()))
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, connection_factory=Connection)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+        if not conn.closed:
+            conn.close()
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.time() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _checkout(self, deadline):
+        """Take an idle connection out of the pool, as a (connection, last
+        used timestamp) pair, or reserve a slot for a new one (None)."""
+        with self._lock:
+            while True:
+                if self.closed:
+                    raise psycopg2.pool.PoolError('Connection pool is closed')
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.maxconn:
+                    self._size += 1
+                    return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('No connection available after {}s'
+                                      .format(self.timeout))
+                self._lock.wait(remaining)
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        # Health checks, rollbacks and connections need round trips to the
+        # server: they are done out of the lock, so a slow or hung socket
+        # does not block the other threads.
+        while True:
+            idle = self._checkout(deadline)
+            if idle is None:
+                break
+            if self._is_alive(*idle):
+                return idle[0]
+            logger.debug('Dropping broken connection to %s', self.dsn)
+            self._discard(idle[0])
+        try:
+            return self._connect()
+        except:  # noqa
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed and not self.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        with self._lock:
+            if not (close or conn.closed or self.closed):
+                self._idle.append((conn, time.time()))
+                self._lock.notify()
+                return
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            # Broken connections are detected and discarded by putconn.
+            self.putconn(conn)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+            self._lock.notify_all()
+
+
+class Rows(list):
+    """Rows as plain tuples, with the names of their `columns`."""
+
+    def __init__(self, rows, columns):
+        super().__init__(rows)
+        self.columns = list(columns)
 
 
 class DB(object):
 
     DEFAULT = "default"
     _ = {}
+    _lock = threading.Lock()
+    _cursors = itertools.count()
+
+    @classmethod
+    def after_fork(cls):
+        # Closing the inherited connections would end the sessions of the
+        # parent: only forget them.
+        cls._ = {}
+        cls._lock = threading.Lock()
 
     @classmethod
-    def connect(cls, dbname=None):
+    def pool(cls, dbname=None):
         dbname = dbname or cls.DEFAULT
         if dbname not in cls._:
-            cls._[dbname] = psycopg2.connect(config.DATABASES[dbname])
+            with cls._lock:
+                if dbname not in cls._:
+                    cls._[dbname] = cls.create_pool(dbname)
         return cls._[dbname]
 
     @classmethod
-    def fetchall(cls, query, args=None, dbname=None):
+    def create_pool(cls, dbname):
+        return Pool(**cls.options(dbname))
+
+    @classmethod
+    def options(cls, dbname):
+        """Connection and pool options of the database `dbname`."""
+        options = dict(config.DB_POOL)
+        params = config.DATABASES[dbname]
+        if isinstance(params, str):
+            params = {'dsn': params}
+        options.update(params)
+        return options
+
+    @classmethod
+    def connection(cls, dbname=None):
+        return cls.pool(dbname).connection()
+
+    @classmethod
+    def fetchall(cls, query, args=None, dbname=None, retry=True):
         before = time.time()
-        cur = DB.connect(dbname).cursor(
-                                cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(query, args)
-        rv = cur.fetchall()
-        cur.close()
+        conn = None
+        try:
+            with cls.connection(dbname) as conn:
+                cur = conn.cursor()
+                if isinstance(query, Statement) and config.PREPARED_STATEMENTS:
+                    cls.execute_prepared(conn, cur, query, args)
+                else:
+                    cur.execute(query, args)
+                rv = Rows(cur.fetchall(),
+                          [column[0] for column in cur.description or []])
+                cur.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # When the connection itself was broken (eg. server restart),
+            # the pool has dropped it: try once again with a fresh one.
+            if not retry or conn is None or not conn.closed:
+                raise
+            logger.debug('Connection lost, retrying query')
+            return cls.fetchall(query, args, dbname, retry=False)
         after = time.time()
         logger.debug('%s => %s\n%s', query, (after - before) * 1000, '*' * 40)
         return rv
 
+    @classmethod
+    def iterate(cls, query, args=None, dbname=None, batch_size=1000):
+        """Yield rows from a server side cursor, `batch_size` at a time.
+
+        The connection is held until the iteration is over (or the generator
+        is closed). The column names of a named cursor are only known after
+        the first fetch, so its rows come as DictRow."""
+        with cls.connection(dbname) as conn:
+            name = 'utilery_{}'.format(next(cls._cursors))
+            cur = conn.cursor(name, cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cur.execute(query, args)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cur.close()
+
+    @classmethod
+    def execute_prepared(cls, conn, cur, statement, args):
+        if statement.name not in conn.prepared:
+            cur.execute('PREPARE {} AS {}'.format(statement.name,
+                                                  statement.prepared))
+            conn.prepared.add(statement.name)
+        sql = 'EXECUTE ' + statement.name
+        if statement.params:
+            sql += ' ({})'.format(', '.join(['%s'] * len(statement.params)))
+        cur.execute(sql, [args[name] for name in statement.params])
+
+
+on_fork(DB.after_fork)
+
 
 def close_connections():
     logger.debug('Closing DB connections')
-    for conn in DB._.values():
-        conn.close()
+    for pool in DB._.values():
+        pool.close()
 atexit.register(close_connections)
 
 
-Plugins.load()
-Plugins.hook('before_load', config=config)
-
-
 def load_recipe(data):
     name = data.get('name', 'default')
     if name in RECIPES:
@@ -68,11 +333,51 @@ def load_recipe(data):
         RECIPES['default'] = RECIPES[data['name']]
 
 
-recipes = config.RECIPES
-if isinstance(recipes, str):
-    recipes = [recipes]
-for recipe in recipes:
-    with Path(recipe).open() as f:
-        load_recipe(yaml.load(f.read()))
+def parse_recipe(path):
+    """Return the data of the recipe file at `path`.
+
+    With RECIPES_CACHE set, the parsed data is kept there, keyed by the hash
+    of the file content, so later processes do not parse it again."""
+    raw = Path(path).read_bytes()
+    if not config.RECIPES_CACHE:
+        return yaml.load(raw, Loader=YAML_LOADER)
+    snapshot = Path(config.RECIPES_CACHE) / '{}.pickle'.format(
+        hashlib.sha1(raw).hexdigest())
+    try:
+        with snapshot.open('rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    data = yaml.load(raw, Loader=YAML_LOADER)
+    try:
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        tmp = snapshot.with_suffix('.{}.tmp'.format(os.getpid()))
+        with tmp.open('wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp), str(snapshot))
+    except OSError as e:
+        logger.warning('Unable to write recipe snapshot %s: %s', snapshot, e)
+    return data
+
+
+def init():
+    """Load the plugins, the cache backend and the recipes.
 
-Plugins.hook('load', config=config, recipes=RECIPES)
+    Nothing is loaded when importing utilery: entry points call this once,
+    before serving. Further calls do nothing."""
+    global INITIALIZED
+    if INITIALIZED:
+        return
+    with _init_lock:
+        if INITIALIZED:
+            return
+        Plugins.load()
+        Cache.load()
+        Plugins.hook('before_load', config=config)
+        recipes = config.RECIPES
+        if isinstance(recipes, str):
+            recipes = [recipes]
+        for recipe in recipes:
+            load_recipe(parse_recipe(recipe))
+        Plugins.hook('load', config=config, recipes=RECIPES)
+        INITIALIZED = True
@@ -0,0 +1,180 @@
+"Expire cached tiles from expire lists or database notifications."
+
+import logging
+import select
+import sys
+
+import mercantile
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+from .cache import Cache
+from .seed import CacheWriter, seed_tiles, tile_order
+
+logger = logging.getLogger(__name__)
+
+
+def parse_tile(line):
+    """Parse a "z/x/y" line, as written by osm2pgsql or imposm."""
+    z, x, y = (int(i) for i in line.strip().split('/'))
+    return mercantile.Tile(x, y, z)
+
+
+def parse_bbox(payload):
+    """Parse a "west,south,east,north" bbox, in longitude/latitude."""
+    bbox = [float(i) for i in payload.replace(',', ' ').split()]
+    if len(bbox) != 4:
+        raise ValueError('Invalid bbox "{}"'.format(payload))
+    return bbox
+
+
+def read_expire_list(lines):
+    for line in lines:
+        if line.strip():
+            yield parse_tile(line)
+
+
+def capped(generate, minzoom, maxzoom, limit=None):
+    """Union of the tiles yielded by `generate(zoom)`, from `minzoom` to
+    `maxzoom`; with a `limit`, the zooms going over it are left out."""
+    found = set()
+    for zoom in range(minzoom, maxzoom + 1):
+        tiles = set()
+        for tile in generate(zoom):
+            tiles.add(tile)
+            if limit is not None and len(found) + len(tiles) > limit:
+                logger.warning('Over %s tiles to expire, zooms %s to %s are '
+                               'left out', limit, zoom, maxzoom)
+                return found
+        found |= tiles
+    return found
+
+
+def affected(tiles, minzoom, maxzoom, limit=None):
+    """Return every tile between `minzoom` and `maxzoom` overlapping one of
+    `tiles`: their parents and their children, within `limit` tiles."""
+    tiles = list(tiles)
+
+    def generate(zoom):
+        for tile in tiles:
+            if zoom < tile.z:
+                shift = tile.z - zoom
+                yield mercantile.Tile(tile.x >> shift, tile.y >> shift, zoom)
+                continue
+            shift = zoom - tile.z
+            xs = range(tile.x << shift, (tile.x + 1) << shift)
+            ys = range(tile.y << shift, (tile.y + 1) << shift)
+            yield from (mercantile.Tile(x, y, zoom) for x in xs for y in ys)
+
+    return capped(generate, minzoom, maxzoom, limit)
+
+
+def bbox_tiles(bbox, minzoom, maxzoom, limit=None):
+    west, south, east, north = bbox
+    return capped(lambda zoom: mercantile.tiles(west, south, east, north,
+                                                zooms=[zoom]),
+                  minzoom, maxzoom, limit)
+
+
+def expire(tiles, recipes, render=False, processes=1, max_render=None):
+    """Purge `tiles` of every recipe in `recipes` from the cache, and render
+    them again if asked: at most `max_render` of them, from the lowest zoom,
+    the others being rendered on demand."""
+    for recipe in recipes:
+        for tile in tiles:
+            Cache.purge(recipe, tile.z, tile.x, tile.y)
+        if render:
+            todo = sorted(tiles, key=tile_order)
+            if max_render is not None and len(todo) > max_render:
+                logger.warning('Rendering only %s of the %s expired tiles',
+                               max_render, len(todo))
+                todo = todo[:max_render]
+            writer = CacheWriter(Cache.backend, recipe, 'all')
+            seed_tiles(writer, todo, recipe=recipe, processes=processes,
+                       resume=False)
+    logger.info('Expired %s tiles', len(tiles) * len(recipes))
+
+
+def parse_notify(payload, minzoom, maxzoom, limit=None):
+    if '/' in payload:
+        return affected([parse_tile(payload)], minzoom, maxzoom, limit)
+    return bbox_tiles(parse_bbox(payload), minzoom, maxzoom, limit)
+
+
+def listen(channel, dbname, minzoom, maxzoom, recipes, render=False,
+           processes=1, timeout=60, max_tiles=None, max_render=None):
+    """Expire the tiles sent through NOTIFY on `channel`, as "z/x/y" tiles or
+    as "west,south,east,north" bboxes."""
+    from .core import DB
+    conn = psycopg2.connect(DB.options(dbname)['dsn'])
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+    logger.info('Listening on channel %s', channel)
+    while True:
+        if select.select([conn], [], [], timeout) == ([], [], []):
+            continue
+        conn.poll()
+        tiles = set()
+        # Group the notifications received together, so diffs touching the
+        # same area only expire it once.
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                tiles |= parse_notify(notify.payload, minzoom, maxzoom,
+                                      max_tiles)
+            except ValueError:
+                logger.error('Invalid payload "%s"', notify.payload)
+        if tiles:
+            expire(tiles, recipes, render=render, processes=processes,
+                   max_render=max_render)
+
+
+def add_arguments(parser):
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='Expire lists ("z/x/y" lines); "-" for stdin')
+    parser.add_argument('--recipe', dest='recipes', action='append',
+                        help='Recipe to expire (can be repeated); '
+                             'default to all of them')
+    parser.add_argument('--minzoom', type=int, default=0)
+    parser.add_argument('--maxzoom', type=int, default=18)
+    parser.add_argument('--render', action='store_true',
+                        help='Render again the expired tiles')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--max-tiles', type=int, default=1000000,
+                        help='Maximum tiles to expire for one expire list '
+                             'or notification')
+    parser.add_argument('--max-render', type=int, default=10000,
+                        help='Maximum expired tiles to render again at once')
+    parser.add_argument('--listen', metavar='CHANNEL',
+                        help='Expire the tiles notified on this channel')
+    parser.add_argument('--dbname', default='default',
+                        help='Database to listen to')
+
+
+def main(args):
+    from .core import RECIPES
+    if Cache.backend is None:
+        raise ValueError('No CACHE configured')
+    if not Cache.backend.shared:
+        raise ValueError('The CACHE backend is not shared between processes')
+    recipes = args.recipes or list(RECIPES)
+    for recipe in recipes:
+        if recipe not in RECIPES:
+            raise ValueError('Unknown recipe "{}"'.format(recipe))
+    if not args.paths and not args.listen:
+        raise ValueError('No expire list nor channel given')
+    for path in args.paths:
+        if path == '-':
+            listed = list(read_expire_list(sys.stdin))
+        else:
+            with open(path) as f:
+                listed = list(read_expire_list(f))
+        expire(affected(listed, args.minzoom, args.maxzoom, args.max_tiles),
+               recipes, render=args.render, processes=args.processes,
+               max_render=args.max_render)
+    if args.listen:
+        listen(args.listen, args.dbname, args.minzoom, args.maxzoom, recipes,
+               render=args.render, processes=args.processes,
+               max_tiles=args.max_tiles, max_render=args.max_render)
@@ -0,0 +1,251 @@
+import gzip
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+import mercantile
+
+from . import config
+from .utils import on_fork
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER,
+                                tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index
+    ON map (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+           map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+CREATE TABLE IF NOT EXISTS utilery_coverage (zoom_level INTEGER,
+                                             min_column INTEGER,
+                                             max_column INTEGER,
+                                             min_row INTEGER, max_row INTEGER);
+CREATE TABLE IF NOT EXISTS utilery_failures (zoom_level INTEGER,
+                                             tile_column INTEGER,
+                                             tile_row INTEGER);
+CREATE UNIQUE INDEX IF NOT EXISTS utilery_failures_index
+    ON utilery_failures (zoom_level, tile_column, tile_row);
+"""
+
+# As mercantile.tiles, so the ranges match the seeded tiles.
+EPSILON = 1e-11
+
+
+class MBTiles(object):
+    """Read and write vector tiles in a MBTiles file.
+
+    Identical tiles (eg. empty ocean ones) are stored only once, using the
+    map/images split of the spec. Tiles are stored gzipped, and rows are
+    in the TMS scheme, as the spec requires.
+
+    The ranges of tiles seeded for each zoom, and the tiles that failed, are
+    kept in utilery_* tables, so tiles skipped because empty can be told
+    from tiles never seeded."""
+
+    _ = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path, batch_size=1000, readonly=False):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.readonly = readonly
+        self._local = threading.local()
+        self._batch = []
+        self._written = False
+        self._metadata = None
+
+    @classmethod
+    def after_fork(cls):
+        # sqlite connections must not be used across a fork.
+        cls._ = {}
+        cls._lock = threading.Lock()
+
+    @classmethod
+    def for_recipe(cls, name):
+        """Return the MBTiles configured for the recipe `name`, if any."""
+        path = (config.MBTILES or {}).get(name)
+        if not path:
+            return None
+        if path not in cls._:
+            with cls._lock:
+                if path not in cls._:
+                    cls._[path] = cls.open(path)
+        return cls._[path]
+
+    @classmethod
+    def open(cls, path):
+        """Open the file at `path` to serve it, or return None if it can't
+        be read."""
+        mbtiles = cls(path, readonly=True)
+        try:
+            mbtiles.metadata
+        except sqlite3.Error as e:
+            logger.warning('Not serving MBTiles %s: %s', path, e)
+            return None
+        return mbtiles
+
+    @property
+    def db(self):
+        # sqlite connections can't be shared between threads.
+        if not hasattr(self._local, 'db'):
+            if self.readonly:
+                # Do not create the file if missing.
+                uri = Path(self.path).resolve().as_uri() + '?mode=ro'
+                self._local.db = sqlite3.connect(uri, uri=True)
+            else:
+                self._local.db = sqlite3.connect(self.path)
+        return self._local.db
+
+    def create(self):
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def row(z, y):
+        return 2 ** z - 1 - y
+
+    def read(self, z, x, y, decompress=True):
+        cursor = self.db.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? '
+            'AND tile_row=?', (z, x, self.row(z, y)))
+        data = cursor.fetchone()
+        if data is None:
+            return None
+        data = bytes(data[0])
+        if decompress and data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return data
+
+    def exists(self, z, x, y):
+        cursor = self.db.execute(
+            'SELECT 1 FROM map WHERE zoom_level=? AND tile_column=? '
+            'AND tile_row=?', (z, x, self.row(z, y)))
+        return cursor.fetchone() is not None
+
+    def write(self, z, x, y, data):
+        # Hashed before compressing: the gzip header holds a timestamp.
+        tile_id = hashlib.md5(data).hexdigest()
+        self._batch.append((z, x, self.row(z, y), tile_id,
+                            gzip.compress(data, mtime=0)))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        images = {}
+        tiles = []
+        for z, x, row, tile_id, data in self._batch:
+            images[tile_id] = data
+            tiles.append((z, x, row, tile_id))
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO images (tile_id, tile_data) '
+                'VALUES (?, ?)', images.items())
+            self.db.executemany(
+                'INSERT OR REPLACE INTO map (zoom_level, tile_column, '
+                'tile_row, tile_id) VALUES (?, ?, ?, ?)', tiles)
+            self.db.executemany(
+                'DELETE FROM utilery_failures WHERE zoom_level=? AND '
+                'tile_column=? AND tile_row=?',
+                [tile[:3] for tile in tiles])
+        self._batch = []
+        self._written = True
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            cursor = self.db.execute('SELECT name, value FROM metadata')
+            self._metadata = dict(cursor.fetchall())
+        return self._metadata
+
+    def set_metadata(self, **metadata):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                [(k, str(v)) for k, v in metadata.items()])
+        self._metadata = None
+
+    @property
+    def zooms(self):
+        try:
+            return (int(self.metadata['minzoom']),
+                    int(self.metadata['maxzoom']))
+        except KeyError:
+            cursor = self.db.execute(
+                'SELECT MIN(zoom_level), MAX(zoom_level) FROM map')
+            return cursor.fetchone()
+
+    @property
+    def bounds(self):
+        if 'bounds' not in self.metadata:
+            return None
+        return [float(i) for i in self.metadata['bounds'].split(',')]
+
+    def cover(self, bbox, minzoom, maxzoom):
+        """Record the tiles of `bbox` from `minzoom` to `maxzoom` as seeded."""
+        west, south, east, north = bbox
+        ranges = []
+        for z in range(minzoom, maxzoom + 1):
+            last = 2 ** z - 1
+            nw = mercantile.tile(west, north, z)
+            se = mercantile.tile(east - EPSILON, south + EPSILON, z)
+            ranges.append((z, max(nw.x, 0), min(se.x, last),
+                           self.row(z, min(se.y, last)),
+                           self.row(z, max(nw.y, 0))))
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO utilery_coverage (zoom_level, min_column, '
+                'max_column, min_row, max_row) VALUES (?, ?, ?, ?, ?)',
+                ranges)
+
+    def fail(self, z, x, y):
+        """Record that the tile could not be seeded."""
+        with self.db:
+            self.db.execute(
+                'INSERT OR IGNORE INTO utilery_failures (zoom_level, '
+                'tile_column, tile_row) VALUES (?, ?, ?)',
+                (z, x, self.row(z, y)))
+
+    @property
+    def has_coverage(self):
+        cursor = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' "
+            "AND name='utilery_coverage'")
+        return cursor.fetchone() is not None
+
+    def contains(self, tile):
+        """Tell whether `tile` (a mercantile.Tile) has been seeded in the
+        file, even if skipped because empty."""
+        if not self.has_coverage:
+            return False
+        row = self.row(tile.z, tile.y)
+        cursor = self.db.execute(
+            'SELECT 1 FROM utilery_coverage WHERE zoom_level=? '
+            'AND ? BETWEEN min_column AND max_column '
+            'AND ? BETWEEN min_row AND max_row AND NOT EXISTS ('
+            'SELECT 1 FROM utilery_failures WHERE zoom_level=? '
+            'AND tile_column=? AND tile_row=?) LIMIT 1',
+            (tile.z, tile.x, row, tile.z, tile.x, row))
+        return cursor.fetchone() is not None
+
+    def close(self):
+        if self._batch:
+            self.flush()
+        if self._written:
+            # Drop the images no more referenced by replaced tiles.
+            with self.db:
+                self.db.execute('DELETE FROM images WHERE tile_id NOT IN '
+                                '(SELECT tile_id FROM map)')
+        if hasattr(self._local, 'db'):
+            self._local.db.close()
+            del self._local.db
+
+
+on_fork(MBTiles.after_fork)
@@ -0,0 +1,159 @@
+"""Counters and histograms, exposed in the Prometheus text format."""
+
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metric(object):
+
+    TYPE = None
+    registry = []
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        self.registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def format_labels(self, key, **extra):
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"'))
+            for k, v in pairs))
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self.samples(key, value))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self.key(labels), 0)
+
+    def samples(self, key, value):
+        yield '{}{} {}'.format(self.name, self.format_labels(key), value)
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            counts, total, count = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key][1:] = [total + value, count + 1]
+
+    def get(self, **labels):
+        """Return the sum and the count of the observed values."""
+        return tuple(self._values.get(self.key(labels), (None, 0, 0))[1:])
+
+    def samples(self, key, value):
+        counts, total, count = value
+        for bound, bucket in zip(self.buckets, counts):
+            le = '+Inf' if bound == math.inf else repr(float(bound))
+            yield '{}_bucket{} {}'.format(
+                self.name, self.format_labels(key, le=le), bucket)
+        yield '{}_sum{} {}'.format(self.name, self.format_labels(key), total)
+        yield '{}_count{} {}'.format(self.name, self.format_labels(key), count)
+
+
+def expose():
+    return '\n'.join(metric.expose() for metric in Metric.registry) + '\n'
+
+
+class Timings(object):
+    """Time spent in each (stage, layer) of a tile rendering.
+
+    Stages are exclusive: time spent in a nested stage (eg. waiting for the
+    database while encoding a layer) is not counted in the outer one. Each
+    thread has its own stack of stages."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, stage, layer, seconds):
+        with self._lock:
+            self.totals[stage, layer] += seconds
+
+    @contextmanager
+    def __call__(self, stage, layer=''):
+        stack = self._local.__dict__.setdefault('stack', [])
+        now = time.perf_counter()
+        if stack:
+            self.add(*stack[-1][0], now - stack[-1][1])
+        stack.append([(stage, layer), now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            labels, started = stack.pop()
+            self.add(*labels, now - started)
+            if stack:
+                stack[-1][1] = now
+
+
+STAGE_SECONDS = Histogram(
+    'utilery_stage_seconds', 'Time spent per stage of tile rendering.',
+    ['recipe', 'layer', 'zoom', 'stage'])
+TILE_SECONDS = Histogram(
+    'utilery_tile_seconds', 'Time spent serving a tile.',
+    ['recipe', 'format', 'zoom'])
+TILE_BYTES = Histogram(
+    'utilery_tile_bytes', 'Size of the served tiles.',
+    ['recipe', 'format', 'zoom'],
+    buckets=[2 ** i for i in range(8, 22, 2)])
+FEATURES = Counter(
+    'utilery_features_total', 'Features rendered.',
+    ['recipe', 'layer', 'zoom'])
+CACHE_HITS = Counter(
+    'utilery_cache_hits_total', 'Tiles served from the cache.',
+    ['recipe', 'format'])
+CACHE_MISSES = Counter(
+    'utilery_cache_misses_total', 'Tiles not found in the cache.',
+    ['recipe', 'format'])
+ERRORS = Counter(
+    'utilery_errors_total', 'Tile requests ending with an error.',
+    ['recipe', 'format', 'status'])
+BUDGET_DROPPED = Counter(
+    'utilery_budget_dropped_total',
+    'Features dropped, stripped of properties or coarsened to fit the tile '
+    'budget.', ['recipe', 'layer', 'action'])
@@ -1,10 +1,29 @@
+import datetime
+import operator
+
 from . import config
+from .mvt import LayerEncoder
+
+
+def to_datetime(value):
+    """Aware datetime of a date, datetime or ISO 8601 string, as YAML gives
+    the timestamps of the recipes."""
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    elif not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
 
 
 class Recipe(dict):
 
     def __init__(self, data):
         super().__init__(data)
+        self.statements = {}
+        if self.get('last_modified') is not None:
+            self['last_modified'] = to_datetime(self['last_modified'])
         self.load_layers(data['layers'])
 
     def load_layers(self, layers):
@@ -21,6 +40,7 @@ class Layer(dict):
     def __init__(self, recipe, data):
         self.recipe = recipe
         super().__init__(data)
+        self.encoder = LayerEncoder(data['name'])
         self.load_queries(data['queries'])
 
     def load_queries(self, queries):
@@ -40,7 +60,81 @@ class Query(dict):
 
     def __init__(self, layer, data):
         self.layer = layer
+        self.statements = {}
+        # Names of the columns of the query SQL, once known.
+        self.columns = None
         super().__init__(data)
 
     def __getattr__(self, name):
         return self.get(name, getattr(self.layer, name))
+
+
+class Columns(object):
+    """Where the geometry and the properties are in the rows of a query.
+
+    Decided once per result set, from the names of its columns, so rows can
+    be plain tuples."""
+
+    __slots__ = ('names', 'geometry', 'properties', 'values')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.geometry = self.names.index('_way')
+        indexes = [i for i, name in enumerate(self.names)
+                   if not name.startswith('_') and name != 'way']
+        self.properties = tuple(self.names[i] for i in indexes)
+        if len(indexes) == 1:
+            index = indexes[0]
+            self.values = lambda row: (row[index], )
+        elif indexes:
+            self.values = operator.itemgetter(*indexes)
+        else:
+            self.values = lambda row: ()
+
+    @classmethod
+    def of(cls, rows, first):
+        """Columns of `rows`, from their cursor description if known, else
+        from the names of the `first` row."""
+        names = getattr(rows, 'columns', None)
+        if names is None:
+            names = list(first.keys())
+        return cls(names)
+
+    def to_tuple(self, row):
+        # Rows as dicts (eg. fixtures) have their values in columns order.
+        if isinstance(row, dict):
+            return tuple(row.values())
+        return row
+
+    def to_properties(self, row):
+        return dict(zip(self.properties, self.values(row)))
+
+
+class Feature(object):
+    """A geometry and its properties.
+
+    Encoders only need `get` and item access, so no dict is built per row."""
+
+    __slots__ = ('geometry', 'properties')
+
+    def __init__(self, geometry, properties):
+        self.geometry = geometry
+        self.properties = properties
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def as_dict(self):
+        return {'geometry': self.geometry, 'properties': self.properties}
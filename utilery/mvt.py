@@ -0,0 +1,232 @@
+"""Encode protobuf tiles layers, without building a message object graph.
+
+Each layer definition gets a LayerEncoder, which keeps the encoded protobuf
+fragments of the keys and values it meets, so tiles only have to write them.
+Winding order, validity and commands of the geometries are handled by
+mapbox_vector_tile (pinned in requirements.txt), so the output is the same as
+`mapbox_vector_tile.encode`."""
+
+import struct
+import threading
+from numbers import Number
+
+import shapely.geometry
+import shapely.wkb
+import shapely.wkt
+from mapbox_vector_tile.encoder import VectorTile
+from mapbox_vector_tile.geom_encoder import GeometryEncoder
+from mapbox_vector_tile.utils import get_encode_options
+
+# Tags (field number << 3 | wire type) of the vector_tile.proto fields.
+TILE_LAYER = b'\x1a'
+LAYER_NAME = b'\x0a'
+LAYER_FEATURE = b'\x12'
+LAYER_KEY = b'\x1a'
+LAYER_VALUE = b'\x22'
+LAYER_EXTENT = b'\x28'
+LAYER_VERSION = b'\x78'
+FEATURE_ID = b'\x08'
+FEATURE_TAGS = b'\x12'
+FEATURE_TYPE = b'\x18'
+FEATURE_GEOMETRY = b'\x22'
+VALUE_STRING = b'\x0a'
+VALUE_DOUBLE = b'\x19'
+VALUE_INT = b'\x20'
+VALUE_BOOL = b'\x38'
+
+# Values of the GeomType enum.
+GEOMETRY_TYPES = {
+    'Point': 1, 'MultiPoint': 1,
+    'LineString': 2, 'MultiLineString': 2,
+    'Polygon': 3, 'MultiPolygon': 3,
+}
+
+INT64 = 1 << 63
+ENCODABLE = (str, int, float)
+
+
+def write_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def varint(value):
+    buffer = bytearray()
+    write_varint(buffer, value)
+    return bytes(buffer)
+
+
+def write_packed(buffer, tag, values):
+    packed = bytearray()
+    for value in values:
+        write_varint(packed, value)
+    buffer += tag
+    write_varint(buffer, len(packed))
+    buffer += packed
+
+
+def delimited(tag, payload):
+    return tag + varint(len(payload)) + payload
+
+
+def encode_value(value):
+    """Protobuf fragment of `value` in the values table of a layer, or None
+    if it can't be encoded."""
+    if isinstance(value, bool):
+        message = VALUE_BOOL + (b'\x01' if value else b'\x00')
+    elif isinstance(value, str):
+        message = delimited(VALUE_STRING, value.encode())
+    elif isinstance(value, int):
+        if not -INT64 <= value < INT64:
+            return None
+        # Negative int64 are sent as their two's complement.
+        message = VALUE_INT + varint(value % (1 << 64))
+    elif isinstance(value, float):
+        message = VALUE_DOUBLE + struct.pack('<d', value)
+    else:
+        return None
+    return delimited(LAYER_VALUE, message)
+
+
+def load_geometry(value):
+    """Shapely geometry of `value` (WKB, WKT, GeoJSON dict or already a
+    geometry), or None if it can't be read."""
+    if isinstance(value, shapely.geometry.base.BaseGeometry):
+        return value
+    if isinstance(value, dict):
+        return shapely.geometry.shape(value)
+    if isinstance(value, memoryview):
+        value = bytes(value)
+    try:
+        return shapely.wkb.loads(value)
+    except Exception:
+        try:
+            return shapely.wkt.loads(value)
+        except Exception:
+            return None
+
+
+def geometry_type(shape):
+    try:
+        return GEOMETRY_TYPES[shape.geom_type]
+    except KeyError:
+        raise ValueError('Cannot encode geometry type {}'.format(
+            shape.geom_type))
+
+
+class Geometries(VectorTile):
+    """Geometry handling of mapbox_vector_tile, for a given extent."""
+
+    def __init__(self, extent):
+        super().__init__()
+        self.layer_options = get_encode_options(
+            layer_options={'extents': extent}, default_options=None)
+
+
+class LayerEncoder(object):
+
+    # Distinct keys and values kept per layer; beyond, the tiles encode them
+    # on the fly, so free text properties do not grow the tables forever.
+    MAX_INTERNED = 4096
+    _geometries = {}
+    _local = threading.local()
+
+    def __init__(self, name):
+        self.name = name
+        self.name_fragment = delimited(LAYER_NAME, name.encode())
+        self.keys = {}
+        self.values = {}
+
+    @classmethod
+    def geometries(cls, extent):
+        if extent not in cls._geometries:
+            cls._geometries[extent] = Geometries(extent)
+        return cls._geometries[extent]
+
+    @classmethod
+    def buffers(cls):
+        """Buffers of the current thread, reused from one tile to the next."""
+        if not hasattr(cls._local, 'buffers'):
+            cls._local.buffers = bytearray(), bytearray()
+        layer, feature = cls._local.buffers
+        del layer[:]
+        del feature[:]
+        return layer, feature
+
+    def intern(self, table, key, encode, value):
+        fragment = table.get(key)
+        if fragment is None:
+            fragment = encode(value)
+            if len(table) < self.MAX_INTERNED:
+                table[key] = fragment
+        return fragment
+
+    def encode(self, features, extent=4096):
+        """Return the tile message holding this layer with `features`."""
+        geometries = self.geometries(extent)
+        layer, buffer = self.buffers()
+        keys, values = {}, {}
+        key_fragments, value_fragments = [], []
+        layer += self.name_fragment
+        for feature in features:
+            geometry = feature.get('geometry')
+            if geometry is None:
+                continue
+            shape = load_geometry(geometry)
+            if shape is None:
+                raise ValueError(
+                    "Can't do geometries that are not wkt, wkb, or shapely "
+                    "geometries")
+            if shape.is_empty:
+                continue
+            shape = geometries.enforce_winding_order(shape)
+            if shape is None or shape.is_empty:
+                continue
+            feature_type = geometry_type(shape)
+            commands = GeometryEncoder(False, extent).encode(shape)
+            if not commands:
+                continue
+            tags = []
+            for key, value in (feature.get('properties') or {}).items():
+                # Lists and dicts (arrays, json, hstore) are skipped, like
+                # mapbox_vector_tile does.
+                if not isinstance(key, str) \
+                   or not isinstance(value, ENCODABLE):
+                    continue
+                # Keyed by type too, so 1, 1.0 and True stay distinct.
+                value_key = (type(value), value)
+                if value_key not in values:
+                    fragment = self.intern(self.values, value_key,
+                                           encode_value, value)
+                    if fragment is None:
+                        continue
+                    values[value_key] = len(value_fragments)
+                    value_fragments.append(fragment)
+                if key not in keys:
+                    keys[key] = len(key_fragments)
+                    key_fragments.append(self.intern(
+                        self.keys, key, lambda k: delimited(
+                            LAYER_KEY, k.encode()), key))
+                tags.append(keys[key])
+                tags.append(values[value_key])
+            del buffer[:]
+            fid = feature.get('id')
+            if isinstance(fid, Number) and not isinstance(fid, bool) \
+               and fid >= 0:
+                buffer += FEATURE_ID
+                write_varint(buffer, int(fid))
+            if tags:
+                write_packed(buffer, FEATURE_TAGS, tags)
+            buffer += FEATURE_TYPE
+            write_varint(buffer, feature_type)
+            write_packed(buffer, FEATURE_GEOMETRY, commands)
+            layer += LAYER_FEATURE
+            write_varint(layer, len(buffer))
+            layer += buffer
+        layer += b''.join(key_fragments)
+        layer += b''.join(value_fragments)
+        layer += LAYER_EXTENT + varint(extent)
+        layer += LAYER_VERSION + b'\x02'
+        return TILE_LAYER + varint(len(layer)) + layer
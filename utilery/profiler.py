@@ -0,0 +1,96 @@
+"""Keep the layer queries slower than a threshold, and sometimes their plan.
+
+Enabled by the SLOW_QUERIES setting; the last entries are kept in memory and
+served by the /debug/slow-queries endpoint."""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .core import DB
+from .utils import on_fork
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueries(object):
+
+    DEFAULTS = {
+        'threshold': 1,
+        'explain': 0,
+        'size': 100,
+    }
+    EXPLAIN = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+    entries = deque(maxlen=DEFAULTS['size'])
+    _lock = threading.Lock()
+    _executor = None
+
+    @classmethod
+    def options(cls):
+        if not config.SLOW_QUERIES:
+            return None
+        options = dict(cls.DEFAULTS)
+        options.update(config.SLOW_QUERIES)
+        return options
+
+    @classmethod
+    def check(cls, sql, params, dbname, duration, **context):
+        """Record the query if it took more than the threshold."""
+        options = cls.options()
+        if options is None or duration < options['threshold']:
+            return None
+        entry = dict(context, sql=str(sql), params=params, dbname=dbname,
+                     duration=duration, time=time.time(), plan=None)
+        logger.warning('Slow query (%.3fs) for %s', duration, context)
+        with cls._lock:
+            if cls.entries.maxlen != options['size']:
+                cls.entries = deque(cls.entries, maxlen=options['size'])
+            cls.entries.append(entry)
+        if random.random() < options['explain']:
+            # Do not make the client wait for the query to run once more.
+            cls.executor().submit(cls.explain, entry)
+        return entry
+
+    @classmethod
+    def after_fork(cls):
+        cls._executor = None
+        cls._lock = threading.Lock()
+
+    @classmethod
+    def executor(cls):
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=1)
+        return cls._executor
+
+    @classmethod
+    def explain(cls, entry):
+        try:
+            rows = DB.fetchall(cls.EXPLAIN + entry['sql'], entry['params'],
+                               dbname=entry['dbname'])
+        except Exception as e:
+            logger.error('Unable to explain query: %s', e)
+            entry['plan'] = str(e)
+        else:
+            entry['plan'] = rows[0][0]
+
+    @classmethod
+    def query(cls, **filters):
+        """Return the recorded entries matching `filters`, slowest first."""
+        with cls._lock:
+            entries = list(cls.entries)
+        entries = [e for e in entries
+                   if all(str(e.get(k)) == str(v) for k, v in filters.items())]
+        return sorted(entries, key=lambda e: e['duration'], reverse=True)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls.entries.clear()
+
+
+on_fork(SlowQueries.after_fork)
@@ -0,0 +1,270 @@
+"Pre-render tiles into a cache directory or a MBTiles file."
+
+import itertools
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+
+import mercantile
+
+from .cache import Cache, FileCache, TileKey
+from .mbtiles import MBTiles
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWriter(object):
+    """Write seeded tiles into a cache backend."""
+
+    def __init__(self, cache, recipe, names, format='pbf'):
+        self.cache = cache
+        self.recipe = recipe
+        self.names = names
+        self.format = format
+
+    def key(self, tile):
+        return TileKey(self.recipe, self.names, tile.z, tile.x, tile.y,
+                       self.format)
+
+    def exists(self, tile):
+        return self.cache.exists(self.key(tile))
+
+    def entries(self, tile, data):
+        """Keys and contents of the tile: plain, and with each compression
+        the view serves to clients accepting it."""
+        from .views import WithEndPoint
+        view = WithEndPoint.endpoints[self.format](request=None)
+        view.setup(self.names, tile.z, tile.x, tile.y, self.recipe)
+        yield view.key, data
+        for encoding in view.compression:
+            view.encoding = encoding
+            yield view.key, view.compress(data)
+
+    def write(self, tile, data):
+        for key, content in self.entries(tile, data):
+            self.cache.set(key, content)
+
+    def fail(self, tile):
+        pass
+
+    def close(self, complete=True):
+        pass
+
+
+class MBTilesWriter(object):
+    """Write seeded tiles into a MBTiles file.
+
+    The seeded area is recorded once complete, so tiles skipped because
+    they are empty can be served as such from the file; bounds and zooms
+    metadata are the envelope of the seeded areas, for TileJSON."""
+
+    def __init__(self, path, recipe, bbox, minzoom, maxzoom):
+        self.mbtiles = MBTiles(path)
+        self.mbtiles.create()
+        self.recipe = recipe
+        self.bbox = bbox
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+
+    def exists(self, tile):
+        return self.mbtiles.exists(tile.z, tile.x, tile.y)
+
+    def write(self, tile, data):
+        self.mbtiles.write(tile.z, tile.x, tile.y, data)
+
+    def fail(self, tile):
+        # Served from the database until seeded again.
+        self.mbtiles.fail(tile.z, tile.x, tile.y)
+
+    def close(self, complete=True):
+        """Flush the tiles, and when all of them have been processed, record
+        the seeded area."""
+        if not complete:
+            self.mbtiles.close()
+            return
+        self.mbtiles.cover(self.bbox, self.minzoom, self.maxzoom)
+        bounds = self.bbox
+        minzoom, maxzoom = self.minzoom, self.maxzoom
+        if self.mbtiles.bounds:
+            old = self.mbtiles.bounds
+            bounds = [min(bounds[0], old[0]), min(bounds[1], old[1]),
+                      max(bounds[2], old[2]), max(bounds[3], old[3])]
+        if 'minzoom' in self.mbtiles.metadata:
+            old = self.mbtiles.zooms
+            minzoom, maxzoom = min(minzoom, old[0]), max(maxzoom, old[1])
+        self.mbtiles.set_metadata(
+            name=self.recipe, format='pbf', type='baselayer', version=1,
+            bounds=','.join(map(str, bounds)), minzoom=minzoom,
+            maxzoom=maxzoom)
+        self.mbtiles.close()
+
+
+def tiles(bbox, minzoom, maxzoom):
+    west, south, east, north = bbox
+    return mercantile.tiles(west, south, east, north,
+                            zooms=range(minzoom, maxzoom + 1))
+
+
+def render(job):
+    """Render a block of tiles through the ServePBF pipeline: one single
+    tile, or the tiles of a metatile.
+
+    Return for each tile its content (None for empty tiles, unless asked
+    otherwise) and the error message if any."""
+    tiles, names, recipe, keep_empty = job
+    from .views import ServePBF
+    view = ServePBF(request=None)
+    view.setup(names, tiles[0].z, tiles[0].x, tiles[0].y, recipe)
+    try:
+        if view.metatile > 1:
+            views = view.render_metatile()
+        else:
+            view.render()
+            views = {tiles[0]: view}
+    except Exception as e:
+        error = getattr(e, 'description', None) or str(e)
+        return [(tile, None, error) for tile in tiles]
+    results = []
+    for tile in tiles:
+        content = views[tile].content
+        # count is None when features are encoded by the database.
+        if (not content or views[tile].count == 0) and not keep_empty:
+            content = None
+        results.append((tile, content, None))
+    return results
+
+
+def blocks(tiles, names, recipe):
+    """Group `tiles` by metatile, when the recipe uses them.
+
+    Tiles are consumed lazily, and are expected in the order of
+    `mercantile.tiles` (by zoom, then column): only one column of metatiles
+    is held at a time."""
+    from .views import ServePBF
+    view = ServePBF(request=None)
+
+    def origins():
+        for tile in tiles:
+            view.setup(names, tile.z, tile.x, tile.y, recipe)
+            yield (tile.z,) + view.metatile_origin, tile
+
+    for _, column in itertools.groupby(origins(), lambda item: item[0][:2]):
+        found = OrderedDict()
+        for key, tile in column:
+            found.setdefault(key, []).append(tile)
+        yield from found.values()
+
+
+def tile_order(tile):
+    """Sort key putting tiles in the order `blocks` expects."""
+    return tile.z, tile.x, tile.y
+
+
+def batches(iterable, size):
+    """Split `iterable` in lists of `size` items, lazily."""
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+
+def seed(writer, bbox, minzoom, maxzoom, names='all', recipe='default',
+         processes=1, resume=True, keep_empty=False):
+    return seed_tiles(writer, tiles(bbox, minzoom, maxzoom), names=names,
+                      recipe=recipe, processes=processes, resume=resume,
+                      keep_empty=keep_empty)
+
+
+def seed_tiles(writer, tiles, names='all', recipe='default', processes=1,
+               resume=True, keep_empty=False):
+    stats = {'rendered': 0, 'skipped': 0, 'empty': 0, 'errors': 0}
+    before = time.time()
+
+    def todo():
+        for tile in tiles:
+            if resume and writer.exists(tile):
+                stats['skipped'] += 1
+                continue
+            yield tile
+
+    jobs = ((block, names, recipe, keep_empty)
+            for block in blocks(todo(), names, recipe))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        # The pool consumes its whole input at once: feed it by batches, so
+        # tiles are not all held in memory.
+        results = itertools.chain.from_iterable(
+            pool.imap_unordered(render, batch, chunksize=16)
+            for batch in batches(jobs, processes * 16 * 4))
+    else:
+        pool = None
+        results = map(render, jobs)
+    complete = False
+    try:
+        for tile, content, error in itertools.chain.from_iterable(results):
+            if error:
+                logger.error('Error while rendering %s: %s', tile, error)
+                writer.fail(tile)
+                stats['errors'] += 1
+            elif content is None:
+                stats['empty'] += 1
+            else:
+                writer.write(tile, content)
+                stats['rendered'] += 1
+        complete = True
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        writer.close(complete)
+    logger.info('Seeded %s tiles in %.2fs (%s skipped, %s empty, %s errors)',
+                stats['rendered'], time.time() - before, stats['skipped'],
+                stats['empty'], stats['errors'])
+    return stats
+
+
+def get_writer(args):
+    if args.mbtiles:
+        if args.names != 'all':
+            raise ValueError('MBTiles can only store all the layers')
+        return MBTilesWriter(args.mbtiles, args.recipe, args.bbox,
+                             args.minzoom, args.maxzoom)
+    if args.output:
+        cache = FileCache(args.output)
+    elif Cache.backend is not None:
+        cache = Cache.backend
+    else:
+        raise ValueError('No --output given and no CACHE configured')
+    return CacheWriter(cache, args.recipe, args.names)
+
+
+def add_arguments(parser):
+    parser.add_argument('--recipe', default='default',
+                        help='Name of the recipe to seed')
+    parser.add_argument('--names', default='all',
+                        help='"+" separated layers names, or "all"')
+    parser.add_argument('--bbox', nargs=4, type=float,
+                        default=[-180, -85.0511, 180, 85.0511],
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='Bounding box to seed, in longitude/latitude')
+    parser.add_argument('--minzoom', type=int, default=0)
+    parser.add_argument('--maxzoom', type=int, default=8)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--output',
+                        help='Cache directory to write the tiles to; '
+                             'defaults to the configured CACHE')
+    parser.add_argument('--mbtiles',
+                        help='MBTiles file to write the tiles to')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='Render again tiles already in the output')
+    parser.add_argument('--keep-empty', action='store_true',
+                        help='Also write tiles without any feature')
+
+
+def main(args):
+    from .core import RECIPES
+    if args.recipe not in RECIPES:
+        raise ValueError('Unknown recipe "{}"'.format(args.recipe))
+    seed(get_writer(args), args.bbox, args.minzoom, args.maxzoom,
+         names=args.names, recipe=args.recipe, processes=args.processes,
+         resume=args.resume, keep_empty=args.keep_empty)
@@ -1,5 +1,221 @@
-from utilery.views import app
-from werkzeug.serving import run_simple
+"""Serve the tiles with pre-forked worker processes."""
 
+import gc
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import select
+import signal
+import socket
+import sys
+import time
 
-run_simple('0.0.0.0', 3579, app, use_debugger=True, use_reloader=True)
+from werkzeug.serving import make_server, run_simple
+
+from .core import close_connections, init
+
+logger = logging.getLogger(__name__)
+
+
+def memory():
+    """Resident memory of the current process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Without /proc, the peak is the best we have.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Worker(object):
+    """Serve requests from the socket shared with the other workers, until
+    stopped or due for recycling."""
+
+    # Seconds between two checks of the stop and recycling conditions.
+    POLL = 1
+
+    def __init__(self, app, sock, threaded=False, max_requests=0,
+                 max_memory=0):
+        self.app = app
+        self.sock = sock
+        self.threaded = threaded
+        # Some jitter, so the workers are not all recycled at once.
+        self.max_requests = max_requests + random.randint(
+            0, max_requests // 10)
+        self.max_memory = max_memory
+        self.requests = 0
+        self.stopping = False
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        return self.app(environ, start_response)
+
+    def stop(self, *args):
+        self.stopping = True
+
+    @property
+    def recycle(self):
+        if self.max_requests and self.requests >= self.max_requests:
+            return 'served {} requests'.format(self.requests)
+        if self.max_memory and memory() > self.max_memory:
+            return 'uses more than {} bytes'.format(self.max_memory)
+        return None
+
+    def run(self):
+        host, port = self.sock.getsockname()[:2]
+        server = make_server(host, port, self, threaded=self.threaded,
+                             fd=self.sock.fileno())
+        # Make server_close wait for the requests in flight.
+        server.daemon_threads = False
+        # Workers race for each connection: the losers must not block in
+        # accept().
+        server.socket.setblocking(False)
+        logger.info('Worker %s serving on %s:%s', os.getpid(), host, port)
+        while not self.stopping:
+            if select.select([server], [], [], self.POLL)[0]:
+                server._handle_request_noblock()
+            reason = self.recycle
+            if reason:
+                logger.info('Recycling worker %s: %s', os.getpid(), reason)
+                break
+        server.server_close()
+
+
+class Master(object):
+    """Bind the socket and keep `workers` processes serving on it."""
+
+    def __init__(self, app, host='0.0.0.0', port=3579, workers=None,
+                 backlog=128, timeout=30, **options):
+        self.app = app
+        self.timeout = timeout
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.backlog = backlog
+        self.options = options
+        self.pids = set()
+        self.stopping = False
+
+    def bind(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+    def spawn(self, sock):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+        # In the worker: database pools, thread pools and other per
+        # process state have been reset by the fork hooks.
+        status = 0
+        try:
+            worker = Worker(self.app, sock, **self.options)
+            signal.signal(signal.SIGTERM, worker.stop)
+            signal.signal(signal.SIGINT, worker.stop)
+            worker.run()
+        except Exception:
+            logger.exception('Worker %s failed', os.getpid())
+            status = 1
+        finally:
+            close_connections()
+            os._exit(status)
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        sock = self.bind()
+        logger.info('Listening on %s:%s with %s workers', self.host,
+                    sock.getsockname()[1], self.workers)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(gc, 'freeze'):
+            # Objects loaded so far (recipes, plugins...) are shared with
+            # the workers: keep the collector from touching, and thus
+            # copying, their pages.
+            gc.freeze()
+        while not self.stopping:
+            while len(self.pids) < self.workers:
+                self.spawn(sock)
+            self.reap()
+            time.sleep(.1)
+        self.kill(signal.SIGTERM)
+        deadline = time.time() + self.timeout
+        while self.pids and time.time() < deadline:
+            self.reap()
+            time.sleep(.1)
+        if self.pids:
+            logger.warning('Killing workers %s', sorted(self.pids))
+            self.kill(signal.SIGKILL)
+            while self.pids:
+                self.reap()
+        sock.close()
+
+    def kill(self, signum):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        for pid in list(self.pids):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+            if done:
+                self.pids.discard(pid)
+                if status and not self.stopping:
+                    logger.warning('Worker %s exited with status %s', pid,
+                                   status)
+
+
+def add_arguments(parser):
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=3579)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes (default: number '
+                             'of cores)')
+    parser.add_argument('--threaded', action='store_true',
+                        help='Serve concurrent requests of a worker in '
+                             'threads')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='Recycle a worker after about this number of '
+                             'requests')
+    parser.add_argument('--max-memory', type=int, default=0,
+                        help='Recycle a worker using more than this memory, '
+                             'in MB')
+    parser.add_argument('--timeout', type=int, default=30,
+                        help='Seconds given to the workers to finish their '
+                             'requests when stopping')
+    parser.add_argument('--dev', action='store_true',
+                        help='Run the development server, with debugger and '
+                             'reloader, in one process')
+
+
+def main(args):
+    # Recipes and plugins are loaded (see core.init) before forking.
+    init()
+    from .views import app
+    if args.dev:
+        run_simple(args.host, args.port, app, use_debugger=True,
+                   use_reloader=True)
+        return
+    master = Master(app, args.host, args.port, workers=args.workers,
+                    threaded=args.threaded, max_requests=args.max_requests,
+                    max_memory=args.max_memory * 2 ** 20,
+                    timeout=args.timeout)
+    master.run()
+
+
+if __name__ == '__main__':
+    from .views import app
+    run_simple('0.0.0.0', 3579, app, use_debugger=True, use_reloader=True)
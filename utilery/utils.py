@@ -1,3 +1,4 @@
+import os
 from importlib import import_module
 
 
@@ -12,3 +13,24 @@ def import_by_path(path):
     module = import_module(module_path)
     attr = getattr(module, name)
     return attr
+
+
+def by_zoom(value, zoom):
+    """Resolve a setting that can be either a scalar, or a dict of
+    {zoom: value}, each value applying from its zoom up to the next one."""
+    if not isinstance(value, dict):
+        return value
+    resolved = None
+    for key in sorted(value):
+        if key > zoom:
+            break
+        resolved = value[key]
+    return resolved
+
+
+def on_fork(func):
+    """Call `func` in the child process after each fork, so it does not
+    reuse the connections, threads and locks of its parent."""
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=func)
+    return func
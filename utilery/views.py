@@ -1,5 +1,16 @@
+import gzip
+import hashlib
+import itertools
 import json
+import logging
 import math
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
 import psycopg2
 
@@ -7,12 +18,67 @@ from werkzeug.exceptions import BadRequest, HTTPException, abort
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Request, Response
 
-from . import config
-from .core import DB, RECIPES
+from . import config, metrics
+from .budget import Budget
+from .cache import Cache, SingleFlight, TileKey
+from .core import DB, PoolTimeout, RECIPES, Rows, Statement, init
+from .mbtiles import MBTiles
+from .models import Columns, Feature
 from .plugins import Plugins
+from .profiler import SlowQueries
+from .utils import by_zoom, on_fork
 
 import mercantile
-import mapbox_vector_tile
+import shapely.affinity
+import shapely.geometry
+import shapely.wkb
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+EXTENSIONS = {'gzip': 'gz', 'br': 'br'}
+# Metrics label of the requests for a recipe that does not exist.
+UNKNOWN = '_unknown'
+COMPRESSORS = {
+    'gzip': lambda content, level: gzip.compress(content, level),
+}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda content, level: brotli.compress(content,
+                                                               quality=level)
+
+
+def quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def dumps(value):
+    """Serialize `value` to JSON bytes, with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()
+
+
+def chunked(parts, size):
+    """Join the bytes of `parts` in chunks of at least `size` bytes."""
+    chunk, length = [], 0
+    for part in parts:
+        chunk.append(part)
+        length += len(part)
+        if length >= size:
+            yield b''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield b''.join(chunk)
 
 
 url_map = Map([
@@ -25,10 +91,13 @@ url_map = Map([
     Rule('/<recipe>/<names>/<int:z>/<int:x>/<int:y>.geojson', endpoint='geojson'),  # noqa
     Rule('/<names>/<int:z>/<int:x>/<int:y>.geojson', endpoint='geojson'),
     Rule('/tilejson/mvt.json', endpoint='tilejson'),
+    Rule('/metrics', endpoint='metrics'),
+    Rule('/debug/slow-queries', endpoint='slow-queries'),
 ])
 
 
 def app(environ, start_response):
+    init()
     urls = url_map.bind_to_environ(environ)
     try:
         endpoint, kwargs = urls.match()
@@ -37,10 +106,7 @@ def app(environ, start_response):
                                 **kwargs)
         if not response:
             response = View.serve(endpoint, request, **kwargs)
-        if isinstance(response, tuple):
-            response = Response(*response)
-        elif isinstance(response, str):
-            response = Response(response)
+        response = make_response(response)
     except HTTPException as e:
         return e(environ, start_response)
     else:
@@ -48,6 +114,14 @@ def app(environ, start_response):
         return response(environ, start_response)
 
 
+def make_response(response):
+    if isinstance(response, tuple):
+        response = Response(*response)
+    elif isinstance(response, str):
+        response = Response(response)
+    return response
+
+
 class WithEndPoint(type):
 
     endpoints = {}
@@ -84,79 +158,467 @@ class View(object, metaclass=WithEndPoint):
 
 class ServeTile(View):
 
-    SQL_TEMPLATE = "SELECT {way}, * FROM ({sql}) AS data WHERE ST_IsValid(way) AND ST_Intersects(way, {bbox})"  # noqa
+    SQL_TEMPLATE = "SELECT {way}{properties} FROM ({sql}) AS data WHERE ST_IsValid(way) AND ST_Intersects(way, {bbox})"  # noqa
     GEOMETRY = "{way}"
     methods = ['GET']
     RADIUS = 6378137
     CIRCUM = 2 * math.pi * RADIUS
     SIZE = 256
+    _executor = None
+    _executor_lock = threading.Lock()
+    flights = SingleFlight()
+    metatile = 1
 
     def get(self, names, z, x, y, recipe=None):
+        self.setup(names, z, x, y, recipe)
+        return self.serve()
+
+    def setup(self, names, z, x, y, recipe=None):
         self.namespace = recipe or "default"
         self.zoom = z
         self.ALL = names == "all"
         self.names = names.split('+')
         self.x = x
         self.y = y
-        return self.serve()
+        self.encoding = self.negotiate_encoding()
+
+    @property
+    def key(self):
+        # Compressed variants are cached apart, eg. as "all.pbf.gz".
+        format = self.endpoint
+        if self.encoding:
+            format += '.' + EXTENSIONS[self.encoding]
+        return TileKey(self.namespace, '+'.join(self.names), self.zoom,
+                       self.x, self.y, format)
+
+    @property
+    def compression(self):
+        """Levels of the compressions available for this format."""
+        levels = (config.COMPRESSION or {}).get(self.endpoint) or {}
+        return {k: v for k, v in levels.items() if k in COMPRESSORS}
+
+    def negotiate_encoding(self):
+        if self.request is None or not self.compression:
+            return None
+        # Prefer brotli when the client accepts both with the same quality.
+        candidates = [e for e in ('br', 'gzip') if e in self.compression]
+        return self.request.accept_encodings.best_match(candidates)
+
+    def compress(self, content):
+        if not self.encoding:
+            return content
+        return COMPRESSORS[self.encoding](content,
+                                          self.compression[self.encoding])
 
     def serve(self):
+        before = time.perf_counter()
+        labels = self.labels
+        try:
+            self.check_names()
+            # With a data version, unchanged tiles are answered without even
+            # looking into the cache.
+            etag = self.version_etag()
+            if etag and etag in self.request.if_none_match:
+                return self.response(b'', etag)
+            content = self.lookup()
+            if content is None:
+                metrics.CACHE_MISSES.inc(**labels)
+                if self.streamed:
+                    return self.streamed_response(before, labels, etag)
+                content = self.flight()
+            else:
+                metrics.CACHE_HITS.inc(**labels)
+        except Exception as e:
+            metrics.ERRORS.inc(status=getattr(e, 'code', 500), **labels)
+            raise
+        metrics.TILE_SECONDS.observe(time.perf_counter() - before,
+                                     zoom=self.zoom, **labels)
+        metrics.TILE_BYTES.observe(len(content), zoom=self.zoom, **labels)
+        return self.response(content, etag)
+
+    def flight(self):
+        # Concurrent requests of the same tile wait for a single render.
+        return self.flights.do(self.key, self.refresh)
+
+    def refresh(self):
+        content = self.compress(self.render())
+        self.store(content)
+        return content
+
+    def lookup(self):
+        """Return the already rendered (and compressed) tile, if any."""
+        content, stale = Cache.get_stale(self.key)
+        if stale:
+            # Serve the expired tile, while rendering it again behind.
+            self.flights.spawn(self.key, self.refresh)
+        return content
+
+    def store(self, content):
+        Cache.set(self.key, content)
+
+    def version_etag(self):
+        recipe = RECIPES.get(self.namespace)
+        if recipe is None or recipe.version is None:
+            return None
+        token = '{}:{}'.format(recipe.version, ':'.join(map(str, self.key)))
+        return hashlib.md5(token.encode()).hexdigest()
+
+    def response(self, content, etag=None):
+        response = Response(content, content_type=self.CONTENT_TYPE)
+        response.set_etag(etag or hashlib.md5(content).hexdigest())
+        return self.add_headers(response)
+
+    def add_headers(self, response):
+        if self.compression:
+            response.vary.add('Accept-Encoding')
+        if self.encoding:
+            response.content_encoding = self.encoding
+        recipe = RECIPES.get(self.namespace)
+        if recipe is not None:
+            # Only the recipe knows when its data changed.
+            if recipe.last_modified:
+                response.last_modified = recipe.last_modified
+            max_age = by_zoom(recipe.max_age, self.zoom)
+            if max_age is not None:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+        return response.make_conditional(self.request)
+
+    @property
+    def streamed(self):
+        return False
+
+    def streamed_response(self, before, labels, etag=None):
+        """Send the tile while it is rendered, and cache it once sent.
+
+        The content is not known upfront, so there is no ETag but the data
+        version one, and concurrent requests of the tile are not merged."""
+        # Unknown recipe or layers must still end with an error status.
+        layers = self.load_layers()
+
+        def generate():
+            sent = []
+            try:
+                for chunk in self.compress_chunks(self.render_chunks(layers)):
+                    sent.append(chunk)
+                    yield chunk
+            except Exception as e:
+                # Too late for an error status: the response is cut short.
+                metrics.ERRORS.inc(status=getattr(e, 'code', 500), **labels)
+                logger.exception('Error while streaming tile %s', self.key)
+                return
+            content = b''.join(sent)
+            self.store(content)
+            metrics.TILE_SECONDS.observe(time.perf_counter() - before,
+                                         zoom=self.zoom, **labels)
+            metrics.TILE_BYTES.observe(len(content), zoom=self.zoom,
+                                       **labels)
+        response = Response(generate(), content_type=self.CONTENT_TYPE)
+        if etag:
+            response.set_etag(etag)
+        return self.add_headers(response)
+
+    def compress_chunks(self, chunks):
+        """Compress `chunks` on the fly, flushing after each of them."""
+        if not self.encoding:
+            yield from chunks
+            return
+        level = self.compression[self.encoding]
+        if self.encoding == 'gzip':
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            process, finish = compressor.compress, compressor.flush
+            flush = partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+        else:
+            compressor = brotli.Compressor(quality=level)
+            process, finish = compressor.process, compressor.finish
+            flush = compressor.flush
+        for chunk in chunks:
+            yield process(chunk) + flush()
+        yield finish()
+
+    def render_chunks(self, layers):
+        self.prefetch(layers)
+        for layer in layers:
+            self.process_layer(layer)
+        with self.timings('encode'):
+            yield from self.chunks()
+        self.record_metrics()
+
+    def render(self):
+        return self.render_layers(self.load_layers())
+
+    def load_layers(self):
         bounds = mercantile.bounds(self.x, self.y, self.zoom)
         self.west, self.south = mercantile.xy(bounds.west, bounds.south)
         self.east, self.north = mercantile.xy(bounds.east, bounds.north)
         self.layers = []
+        self.pending = {}
+        self.count = 0
+        self.size = 0
+        self.timings = metrics.Timings()
+        self.features = Counter()
+        self.check_names()
+        self.recipe = RECIPES[self.namespace]
+        names = self.recipe.layers.keys() if self.ALL else self.names
+        return [self.recipe.layers[name] for name in names]
+
+    @property
+    def labels(self):
+        # Unknown recipes share one label, so URLs can't add series.
+        recipe = self.namespace if self.namespace in RECIPES else UNKNOWN
+        return {'recipe': recipe, 'format': self.endpoint}
+
+    def check_names(self):
+        """Abort on unknown recipe or layers: names from the URL must not
+        end up in cache keys or metrics labels."""
         if self.namespace not in RECIPES:
             msg = 'Recipe "{}" not found. Available recipes are: {}'
             abort(400, msg.format(self.namespace, list(RECIPES.keys())))
-        self.recipe = RECIPES[self.namespace]
-        names = self.recipe.layers.keys() if self.ALL else self.names
-        for name in names:
-            if name not in self.recipe.layers:
+        layers = RECIPES[self.namespace].layers
+        for name in ([] if self.ALL else self.names):
+            if name not in layers:
                 abort(400, u'Layer "{}" not found in recipe {}'.format(
                     name, self.namespace))
-            self.process_layer(self.recipe.layers[name])
-        self.post_process()
 
-        return self.content, 200, {"Content-Type": self.CONTENT_TYPE}
+    def render_layers(self, layers):
+        self.prefetch(layers)
+        for layer in layers:
+            self.process_layer(layer)
+        with self.timings('encode'):
+            self.post_process()
+        self.record_metrics()
+        return self.content
+
+    def record_metrics(self):
+        for (stage, layer), seconds in self.timings.totals.items():
+            metrics.STAGE_SECONDS.observe(seconds, recipe=self.namespace,
+                                          layer=layer, zoom=self.zoom,
+                                          stage=stage)
+        for layer, count in self.features.items():
+            metrics.FEATURES.inc(count, recipe=self.namespace, layer=layer,
+                                 zoom=self.zoom)
+
+    @classmethod
+    def after_fork(cls):
+        # Threads and the calls in flight of the parent are not ours.
+        cls._executor = None
+        cls._executor_lock = threading.Lock()
+        cls.flights = SingleFlight()
+
+    @classmethod
+    def executor(cls):
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(
+                        max_workers=config.PARALLEL_QUERIES)
+        return cls._executor
+
+    def prefetch(self, layers):
+        """Send all the queries of the tile at once to the thread pool.
+
+        Results are consumed in recipe order by query_layer."""
+        if not config.PARALLEL_QUERIES:
+            return
+        for query in self.prefetchable(layers):
+            if id(query) not in self.pending:
+                # Only the time waiting for the rows is measured, in
+                # query_features.
+                self.pending[id(query)] = self.executor().submit(
+                    self.execute, self.sql(query), query.dbname,
+                    query.layer['name'])
+
+    def prefetchable(self, layers):
+        """Queries whose rows can be fetched before rendering the tile."""
+        for layer in layers:
+            for query in self.layer_queries(layer):
+                if not query.stream:
+                    yield query
 
     def process_layer(self, layer):
-        layer_data = self.query_layer(layer)
-        self.add_layer_data(layer_data)
+        # Features are lazily fetched and converted while encoding the
+        # layer, those stages are timed apart.
+        with self.timings('encode', layer['name']):
+            layer_data = self.query_layer(layer)
+            self.add_layer_data(layer_data)
 
-    def query_layer(self, layer):
-        features = []
+    def layer_queries(self, layer):
         for query in layer.queries:
             if self.zoom < query.get('minzoom', 0) \
                or self.zoom > query.get('maxzoom', 22):
                 continue
-            sql = self.sql(query)
-            try:
-                rows = DB.fetchall(sql, dbname=query.dbname)
-            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-                msg = str(e)
-                if config.DEBUG:
-                    msg = "{} ** Query was: {}".format(msg, sql)
-                abort(500, msg)
-            features += [self.to_feature(row, layer) for row in rows]
+            yield query
+
+    def query_layer(self, layer):
+        features = itertools.chain.from_iterable(
+            self.query_features(query, layer)
+            for query in self.layer_queries(layer))
+        if layer.max_features:
+            features = itertools.islice(features, layer.max_features)
         return self.to_layer(layer, features)
 
+    def query_features(self, query, layer):
+        future = self.pending.pop(id(query), None)
+        if future:
+            with self.timings('db', layer['name']):
+                result = future.result()
+        elif query.stream:
+            result = self.stream(query)
+        else:
+            result = self.fetch(query)
+        rows = iter(result)
+        first = next(rows, None)
+        if first is None:
+            return
+        columns = Columns.of(result, first)
+        self.remember_columns(query, columns.names)
+        max_bytes = self.recipe.max_bytes
+        name = layer['name']
+        for row in itertools.chain([first], rows):
+            row = columns.to_tuple(row)
+            self.size += len(row[columns.geometry] or b'')
+            if max_bytes and self.size > max_bytes:
+                logger.warning('Tile %s/%s/%s is over %s bytes, skipping '
+                               'remaining features', self.zoom, self.x,
+                               self.y, max_bytes)
+                return
+            self.count += 1
+            self.features[name] += 1
+            with self.timings('convert', name):
+                feature = self.to_feature(row, columns, layer)
+            yield feature
+
+    def fetch(self, query):
+        sql = self.sql(query)
+        with self.timings('db', query.layer['name']):
+            return self.execute(sql, query.dbname, query.layer['name'])
+
+    def execute(self, sql, dbname=None, layer=''):
+        before = time.perf_counter()
+        with self.db_errors(sql):
+            rows = DB.fetchall(sql, self.params, dbname=dbname)
+        self.profile(sql, dbname, time.perf_counter() - before, layer)
+        return rows
+
+    def profile(self, sql, dbname, duration, layer=''):
+        SlowQueries.check(sql, self.params, dbname, duration,
+                          recipe=self.namespace, layer=layer,
+                          format=self.endpoint, zoom=self.zoom, x=self.x,
+                          y=self.y)
+
+    def stream(self, query):
+        # Server side cursors can't be used with prepared statements.
+        sql = str(self.sql(query))
+        with self.db_errors(sql):
+            rows = DB.iterate(sql, self.params, dbname=query.dbname,
+                              batch_size=config.STREAM_BATCH_SIZE)
+            duration = 0
+            while True:
+                before = time.perf_counter()
+                with self.timings('db', query.layer['name']):
+                    row = next(rows, None)
+                duration += time.perf_counter() - before
+                if row is None:
+                    break
+                yield row
+        self.profile(sql, query.dbname, duration, query.layer['name'])
+
+    @contextmanager
+    def db_errors(self, sql):
+        try:
+            yield
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            msg = str(e)
+            if config.DEBUG:
+                msg = "{} ** Query was: {}".format(msg, sql)
+            abort(500, msg)
+        except PoolTimeout as e:
+            abort(503, str(e))
+
+    @property
+    def params(self):
+        """Values of the Statement placeholders for the current tile."""
+        return {
+            'west': self.west,
+            'south': self.south,
+            'east': self.east,
+            'north': self.north,
+            'zoom': self.zoom,
+            'pixel_width': self.CIRCUM / self.SIZE / 2 ** self.zoom,
+        }
+
     def sql(self, query):
-        srid = query.srid
-        bbox = 'ST_SetSRID(ST_MakeBox2D(ST_MakePoint({west}, {south}), ST_MakePoint({east}, {north})), {srid})'  # noqa
-        bbox = bbox.format(west=self.west, south=self.south, east=self.east,
-                           north=self.north, srid=srid)
-        pixel_width = self.CIRCUM / (self.SIZE * query.scale) / 2 ** self.zoom
-        if query.buffer:
-            units = query.buffer * pixel_width
-            bbox = 'ST_Expand({bbox}, {units})'.format(bbox=bbox, units=units)
+        # Tile values are parameters, so the SQL is only built once per
+        # query and format.
+        if self.endpoint not in query.statements:
+            with self.timings('sql', query.layer['name']):
+                sql = Statement(self.build_sql(query))
+            query.statements[self.endpoint] = sql
+        return query.statements[self.endpoint]
+
+    def build_sql(self, query):
+        bbox = self.bbox(query)
         geometry = self.geometry
-        if query.clip:
-            geometry = geometry.format(way='ST_Intersection({way}, {bbox})')
+        way = 'ST_Intersection({way}, {bbox})' if query.clip else '{way}'
+        geometry = geometry.format(way=self.simplify(way, query))
         geometry = geometry.format(way='way', bbox=bbox)
+        sql = self.SQL_TEMPLATE.format(way=geometry,
+                                       properties=self.properties_sql(query),
+                                       sql=self.query_sql(query, bbox),
+                                       bbox=bbox)
+        return sql + self.area_filter(query)
+
+    def properties_sql(self, query):
+        """Columns selected along the geometry: all of them until the ones
+        of the query are known, then only those used as properties, so the
+        full resolution "way" is not sent with each row."""
+        if query.columns is None:
+            return ', *'
+        return ''.join(', data.' + quote_ident(name)
+                       for name in query.columns
+                       if name != 'way' and not name.startswith('_'))
+
+    def remember_columns(self, query, names):
+        """Keep the columns of the query, from its first result, and build
+        its statements again with only the properties."""
+        if query.columns is None:
+            query.columns = [name for name in names if name != '_way']
+            query.statements.clear()
+
+    def simplify(self, way, query):
+        """Wrap the `way` SQL expression in the simplification and the
+        snapping asked by the query, both in pixels."""
+        if query.simplify:
+            way = 'ST_SimplifyPreserveTopology({}, {} * {})'.format(
+                way, float(query.simplify), self.pixel_width(query))
+        if query.snap_to_grid:
+            way = 'ST_SnapToGrid({}, {} * {})'.format(
+                way, float(query.snap_to_grid), self.pixel_width(query))
+        return way
+
+    def area_filter(self, query):
+        """Drop the polygons smaller than min_area_pixels."""
+        if not query.min_area_pixels:
+            return ''
+        return (' AND (ST_Dimension(way) < 2 OR ST_Area(way) >= {} * {} ^ 2)'
+                .format(float(query.min_area_pixels), self.pixel_width(query)))
+
+    def pixel_width(self, query):
+        if query.scale == 1:
+            return '!pixel_width!'
+        return '(!pixel_width! / {})'.format(query.scale)
+
+    def bbox(self, query, buffered=True):
+        bbox = 'ST_SetSRID(ST_MakeBox2D(ST_MakePoint(!west!, !south!), ST_MakePoint(!east!, !north!)), {srid})'  # noqa
+        bbox = bbox.format(srid=query.srid)
+        if buffered and query.buffer:
+            units = '{} * {}'.format(query.buffer, self.pixel_width(query))
+            bbox = 'ST_Expand({bbox}, {units})'.format(bbox=bbox, units=units)
+        return bbox
+
+    def query_sql(self, query, bbox):
         sql = query['sql'].replace('!bbox!', bbox)
-        sql = sql.replace('!zoom!', str(self.zoom))
-        sql = sql.replace('!pixel_width!', str(pixel_width))
-        return self.SQL_TEMPLATE.format(way=geometry, sql=sql, bbox=bbox)
+        return sql.replace('!pixel_width!', self.pixel_width(query))
 
     def to_layer(self, layer, features):
         return {
@@ -167,16 +629,9 @@ class ServeTile(View):
     def add_layer_data(self, data):
         self.layers.append(data)
 
-    def to_feature(self, row, layer):
-        return {
-            "geometry": self.process_geometry(row['_way']),
-            "properties": self.row_to_dict(row)
-        }
-
-    def row_to_dict(self, row):
-        def f(item):
-            return not item[0].startswith('_') and item[0] != 'way'
-        return dict(i for i in row.items() if f(i))
+    def to_feature(self, row, columns, layer):
+        return Feature(self.process_geometry(row[columns.geometry]),
+                       columns.to_properties(row))
 
     def process_geometry(self, geometry):
         return geometry
@@ -186,22 +641,284 @@ class ServeTile(View):
         return self.GEOMETRY
 
 
+on_fork(ServeTile.after_fork)
+
+
 class ServePBF(ServeTile):
 
     endpoint = 'pbf'
 
     SCALE = 4096
     CONTENT_TYPE = 'application/x-protobuf'
+    extent = SCALE
+    MVT_QUERY = "SELECT ST_AsMVTGeom({way}, {bounds}, {extent}, {buffer}, {clip}) AS _geom{properties} FROM ({sql}) AS data WHERE ST_IsValid(way) AND ST_Intersects(way, {bbox})"  # noqa
+    # When the columns of the query can't be known: slower, as the whole
+    # row, geometry included, is converted to jsonb.
+    MVT_PROPERTIES = ", (SELECT COALESCE(jsonb_object_agg(key, value), '{{}}') FROM jsonb_each(to_jsonb(data)) WHERE key != 'way' AND left(key, 1) != '_') AS _properties"  # noqa
+    MVT_LAYER = "COALESCE((SELECT ST_AsMVT(layer, '{name}', {extent}, '_geom') FROM ({sql}) AS layer WHERE _geom IS NOT NULL), '')"  # noqa
+    _mvt_support = {}
 
     @property
     def geometry(self):
-        return ('ST_AsText(ST_TransScale(%s, %.12f, %.12f, %.12f, %.12f)) as _way'  # noqa
-                % (self.GEOMETRY, -self.west, -self.south,
-                self.SCALE / (self.east - self.west),
-                self.SCALE / (self.north - self.south)))
+        # Geometries are sent in binary, with coordinates already scaled and
+        # snapped to the tile grid. "-1 *" and not "-", which would make a
+        # comment out of negative values inlined by psycopg2.
+        # The extent is a parameter, so metatiles can use the same
+        # statements with a larger grid.
+        return ('ST_AsBinary(ST_SnapToGrid(ST_TransScale({}, -1 * !west!, '
+                '-1 * !south!, !extent! / (!east! - !west!), '
+                '!extent! / (!north! - !south!)), 1)) as _way'
+                .format(self.GEOMETRY))
+
+    @property
+    def params(self):
+        params = super().params
+        params['extent'] = self.extent
+        return params
+
+    def process_geometry(self, geometry):
+        # psycopg2 gives bytea as memoryview, the encoder wants bytes.
+        if isinstance(geometry, memoryview):
+            return geometry.tobytes()
+        return geometry
+
+    def lookup(self):
+        # Answer from the recipe MBTiles when it has the tile: tiles missing
+        # from an area seeded have been skipped because empty.
+        mbtiles = MBTiles.for_recipe(self.namespace)
+        data = None
+        if mbtiles is not None and self.ALL:
+            data = mbtiles.read(self.zoom, self.x, self.y, decompress=False)
+            tile = mercantile.Tile(self.x, self.y, self.zoom)
+            if data is None and mbtiles.contains(tile):
+                data = b''
+        if data is not None:
+            if data[:2] == GZIP_MAGIC:
+                # Stored gzipped: send it as is when the client accepts it.
+                if self.encoding == 'gzip':
+                    return data
+                data = gzip.decompress(data)
+            return self.compress(data)
+        return super().lookup()
+
+    @property
+    def metatile(self):
+        """Number of tiles per side of the blocks rendered at once."""
+        recipe = RECIPES.get(self.namespace)
+        if recipe is None or recipe.engine == 'postgis':
+            return 1
+        return min(recipe.metatile or 1, 2 ** self.zoom)
+
+    @property
+    def metatile_origin(self):
+        return self.x - self.x % self.metatile, self.y - self.y % self.metatile
+
+    def flight(self):
+        if self.metatile == 1:
+            return super().flight()
+        x, y = self.metatile_origin
+        key = ('metatile', self.metatile) + self.key._replace(x=x, y=y)
+        return self.flights.do(key, self.refresh_metatile)[(self.x, self.y)]
+
+    def refresh_metatile(self):
+        contents = {}
+        for tile, view in self.render_metatile().items():
+            view.encoding = self.encoding
+            contents[tile.x, tile.y] = view.compress(view.content)
+            view.store(contents[tile.x, tile.y])
+        return contents
+
+    def render_metatile(self):
+        """Render the whole block of tiles the current one belongs to, with
+        one query per layer query, and return the rendered view of each
+        tile."""
+        size = self.metatile
+        x0, y0 = self.metatile_origin
+        layers = self.load_layers()
+        # Fetch the block in a grid of size * SCALE units, so each tile
+        # gets its usual SCALE units once translated.
+        nw = mercantile.bounds(x0, y0, self.zoom)
+        se = mercantile.bounds(x0 + size - 1, y0 + size - 1, self.zoom)
+        self.west, self.north = mercantile.xy(nw.west, nw.north)
+        self.east, self.south = mercantile.xy(se.east, se.south)
+        self.extent = self.SCALE * size
+        self.prefetch(layers)
+        queries = [query for layer in layers
+                   for query in self.layer_queries(layer)]
+        geometries = {}
+        for query in queries:
+            future = self.pending.pop(id(query), None)
+            if future:
+                with self.timings('db', query.layer['name']):
+                    rows = future.result()
+            else:
+                rows = self.fetch(query)
+            with self.timings('convert', query.layer['name']):
+                geometries[id(query)] = self.parse(rows)
+            columns = geometries[id(query)][0]
+            if columns is not None:
+                self.remember_columns(query, columns.names)
+        self.record_metrics()
+        names = 'all' if self.ALL else '+'.join(self.names)
+        views = {}
+        for row, column in itertools.product(range(size), range(size)):
+            tile = mercantile.Tile(x0 + column, y0 + row, self.zoom)
+            view = type(self)(None)
+            view.setup(names, tile.z, tile.x, tile.y, self.namespace)
+            tile_layers = view.load_layers()
+            # Block grid y axis goes north, tiles rows go south.
+            offset = (column * self.SCALE, (size - 1 - row) * self.SCALE)
+            for query in queries:
+                future = Future()
+                columns, parsed = geometries[id(query)]
+                if columns is None:
+                    future.set_result([])
+                else:
+                    future.set_result(Rows(
+                        self.split(parsed, columns, query, offset),
+                        columns.names))
+                view.pending[id(query)] = future
+            view.render_layers(tile_layers)
+            views[tile] = view
+        return views
+
+    @staticmethod
+    def parse(rows):
+        """Return the columns of `rows`, and their (row, shapely geometry)
+        pairs."""
+        if not rows:
+            return None, []
+        columns = Columns.of(rows, rows[0])
+        parsed = []
+        for row in rows:
+            row = columns.to_tuple(row)
+            if row[columns.geometry] is not None:
+                geometry = shapely.wkb.loads(bytes(row[columns.geometry]))
+                parsed.append((row, geometry))
+        return columns, parsed
+
+    def split(self, geometries, columns, query, offset):
+        """Yield the rows of the tile at `offset` in the metatile grid, with
+        geometries translated to the tile grid, and clipped if needed."""
+        buffer = (query.buffer or 0) * self.SCALE / self.SIZE / query.scale
+        minx, miny = offset[0] - buffer, offset[1] - buffer
+        maxx = offset[0] + self.SCALE + buffer
+        maxy = offset[1] + self.SCALE + buffer
+        box = shapely.geometry.box(minx, miny, maxx, maxy)
+        for row, geometry in geometries:
+            bounds = geometry.bounds
+            if bounds[0] > maxx or bounds[2] < minx or bounds[1] > maxy \
+               or bounds[3] < miny or not geometry.intersects(box):
+                continue
+            if query.clip:
+                geometry = geometry.intersection(box)
+                if geometry.is_empty:
+                    continue
+            geometry = shapely.affinity.translate(geometry, -offset[0],
+                                                  -offset[1])
+            index = columns.geometry
+            yield row[:index] + (geometry.wkb, ) + row[index + 1:]
+
+    def prefetchable(self, layers):
+        if self.recipe.engine == 'postgis':
+            return []
+        return super().prefetchable(layers)
+
+    def render_layers(self, layers):
+        if self.recipe.engine != 'postgis':
+            return super().render_layers(layers)
+        statements = OrderedDict()
+        for layer in layers:
+            queries = list(self.layer_queries(layer))
+            if not queries:
+                continue
+            if not self.has_mvt(layer.dbname):
+                logger.warning('ST_AsMVT not available in database %s, '
+                               'falling back to python engine', layer.dbname)
+                return super().render_layers(layers)
+            statements.setdefault(layer.dbname, []).append((layer, queries))
+        # Layers are encoded and concatenated by the database: one query per
+        # database, and features never get to python.
+        self.count = None
+        contents = []
+        for dbname, layers in statements.items():
+            sql = self.mvt_sql(layers)
+            with self.timings('db'):
+                contents.append(bytes(self.execute(sql, dbname)[0][0]))
+        self.content = b''.join(contents)
+        self.record_metrics()
+        return self.content
+
+    def mvt_sql(self, layers):
+        key = tuple(id(q) for layer, queries in layers for q in queries)
+        if key not in self.recipe.statements:
+            sql = 'SELECT ' + ' || '.join(
+                self.MVT_LAYER.format(
+                    name=layer['name'].replace("'", "''"), extent=self.SCALE,
+                    sql=' UNION ALL '.join(self.mvt_query_sql(q)
+                                           for q in queries))
+                for layer, queries in layers)
+            self.recipe.statements[key] = Statement(sql)
+        return self.recipe.statements[key]
+
+    def mvt_query_sql(self, query):
+        # ST_AsMVTGeom wants the buffer in tile extent units.
+        buffer = (query.buffer or 0) * self.SCALE / self.SIZE / query.scale
+        self.probe_columns(query)
+        if query.columns is None:
+            properties = self.MVT_PROPERTIES
+        else:
+            properties = self.properties_sql(query)
+        sql = self.MVT_QUERY.format(
+            way=self.simplify('way', query), properties=properties,
+            bounds=self.bbox(query, buffered=False), extent=self.SCALE,
+            buffer=int(round(buffer)), clip='true' if query.clip else 'false',
+            sql=self.query_sql(query, self.bbox(query)),
+            bbox=self.bbox(query))
+        return sql + self.area_filter(query)
+
+    def probe_columns(self, query):
+        """Ask the database for the columns of the query, as no row of it
+        gets to python with this engine."""
+        if query.columns is not None:
+            return
+        sql = Statement('SELECT * FROM ({}) AS data LIMIT 0'.format(
+            self.query_sql(query, self.bbox(query))))
+        rows = self.execute(sql, query.dbname, query.layer['name'])
+        if getattr(rows, 'columns', None):
+            query.columns = list(rows.columns)
+
+    def has_mvt(self, dbname):
+        if dbname not in self._mvt_support:
+            rows = self.execute("SELECT 1 FROM pg_proc "
+                                "WHERE proname = 'st_asmvt'", dbname)
+            self._mvt_support[dbname] = bool(rows)
+        return self._mvt_support[dbname]
+
+    @property
+    def budget(self):
+        if self.recipe.max_tile_size or self.recipe.max_tile_features:
+            return Budget(self.recipe, self.zoom, self.recipe.max_tile_size,
+                          self.recipe.max_tile_features)
+        return None
+
+    def add_layer_data(self, data):
+        if self.budget:
+            # Keep the features, they may need to be reworked to fit.
+            data['features'] = list(data['features'])
+            self.layers.append((self.recipe.layers[data['name']], data))
+        else:
+            # Encode layers one at a time, so streamed features are
+            # consumed, and their DB connection released, before the next
+            # layer.
+            layer = self.recipe.layers[data['name']]
+            self.layers.append(layer.encoder.encode(data['features']))
 
     def post_process(self):
-        self.content = mapbox_vector_tile.encode(self.layers)
+        budget = self.budget
+        if budget:
+            self.layers = budget.fit(self.layers)
+        self.content = b''.join(self.layers)
 
 
 class ServeJSON(ServeTile):
@@ -210,12 +927,44 @@ class ServeJSON(ServeTile):
 
     GEOMETRY = "ST_AsGeoJSON(ST_Transform({way}, 4326)) as _way"  # noqa
     CONTENT_TYPE = 'application/json'
+    # Size of the chunks of the streamed responses.
+    CHUNK_SIZE = 2 ** 16
+
+    @property
+    def streamed(self):
+        return bool(config.STREAM_RESPONSES)
 
     def post_process(self):
-        self.content = json.dumps(self.layers)
+        self.content = b''.join(self.chunks())
+
+    def chunks(self):
+        return chunked(self.parts(), self.CHUNK_SIZE)
+
+    def parts(self):
+        yield b'['
+        for i, data in enumerate(self.layers):
+            yield b'{"name": ' if not i else b', {"name": '
+            yield dumps(data['name'])
+            yield b', "features": ['
+            yield from self.features_parts(data['features'])
+            yield b']}'
+        yield b']'
+
+    def features_parts(self, features):
+        for i, feature in enumerate(features):
+            if i:
+                yield b', '
+            yield self.feature_json(feature)
+
+    def feature_json(self, feature):
+        return (b'{"geometry": ' + feature.geometry + b', "properties": ' +
+                dumps(feature.properties) + b'}')
 
     def process_geometry(self, geometry):
-        return json.loads(geometry)
+        # Already GeoJSON: spliced as is in the output.
+        if geometry is None:
+            return b'null'
+        return geometry.encode()
 
 
 class ServeGeoJSON(ServeJSON):
@@ -225,20 +974,20 @@ class ServeGeoJSON(ServeJSON):
     def to_layer(self, layer, features):
         return features
 
-    def add_layer_data(self, data):
-        self.layers.extend(data)
-
-    def to_feature(self, row, layer):
-        feature = super(ServeGeoJSON, self).to_feature(row, layer)
-        feature["type"] = "Feature"
-        feature['properties']['layer'] = layer['name']
+    def to_feature(self, row, columns, layer):
+        feature = super(ServeGeoJSON, self).to_feature(row, columns, layer)
+        feature.properties['layer'] = layer['name']
         return feature
 
-    def post_process(self):
-        self.content = json.dumps({
-            "type": "FeatureCollection",
-            "features": self.layers
-        })
+    def parts(self):
+        yield b'{"type": "FeatureCollection", "features": ['
+        yield from self.features_parts(itertools.chain.from_iterable(
+            self.layers))
+        yield b']}'
+
+    def feature_json(self, feature):
+        return (b'{"geometry": ' + feature.geometry + b', "properties": ' +
+                dumps(feature.properties) + b', "type": "Feature"}')
 
 
 class TileJson(View):
@@ -246,7 +995,8 @@ class TileJson(View):
     endpoint = 'tilejson'
 
     def get(self):
-        base = config.TILEJSON
+        base = dict(config.TILEJSON)
+        self.add_mbtiles_metadata(base)
         base['vector_layers'] = []
         for recipe in RECIPES.values():
             for layer in recipe.layers.values():
@@ -255,3 +1005,37 @@ class TileJson(View):
                     "id": layer.id
                 })
         return json.dumps(base)
+
+    def add_mbtiles_metadata(self, base):
+        files = [MBTiles.for_recipe(name) for name in RECIPES]
+        files = [f for f in files if f is not None and f.bounds]
+        if not files:
+            return
+        bounds = [f.bounds for f in files]
+        base['bounds'] = [min(b[0] for b in bounds), min(b[1] for b in bounds),
+                          max(b[2] for b in bounds), max(b[3] for b in bounds)]
+        base['minzoom'] = min(f.zooms[0] for f in files)
+        base['maxzoom'] = max(f.zooms[1] for f in files)
+
+
+class Metrics(View):
+
+    endpoint = 'metrics'
+
+    def get(self):
+        if not config.METRICS:
+            abort(404)
+        return Response(metrics.expose(),
+                        content_type='text/plain; version=0.0.4')
+
+
+class DebugSlowQueries(View):
+
+    endpoint = 'slow-queries'
+
+    def get(self):
+        if not config.SLOW_QUERIES:
+            abort(404)
+        entries = SlowQueries.query(**self.request.args.to_dict())
+        return Response(json.dumps(entries, default=str),
+                        content_type='application/json')